@@ -1,10 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.models import Group
 from django.contrib.postgres.aggregates import StringAgg
-from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
 from accounts.models import CustomUser
+from baskets.email import email_users_response
 
 
 @admin.register(CustomUser)
@@ -47,11 +47,23 @@ class MembershipInline(admin.TabularInline):
     extra = 0
 
 
+@admin.action(description=_("Email members of selected groups"))
+def email_group_members(modeladmin, request, queryset):
+    groups = queryset
+    return email_users_response(
+        modeladmin,
+        request,
+        groups,
+        CustomUser.objects.filter(groups__in=groups).distinct(),
+    )
+
+
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
-    list_display = ("name", "members_count", "email")
+    list_display = ("name", "members_count")
     exclude = ("permissions",)
     inlines = [MembershipInline]
+    actions = [email_group_members]
 
     class Media:
         css = {"all": ("baskets/css/hide_admin_original.css",)}
@@ -59,13 +71,3 @@ class GroupAdmin(admin.ModelAdmin):
     @admin.display(description=_("number of members"))
     def members_count(self, obj):
         return obj.user_set.count()
-
-    @staticmethod
-    def email(group):
-        emails_str = ", ".join(group.user_set.values_list("email", flat=True))
-        link_text = _("email the group")
-        return (
-            format_html(f"<a href='mailto:?bcc={emails_str}'>{link_text}</a>")
-            if emails_str
-            else ""
-        )
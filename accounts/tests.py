@@ -1,5 +1,7 @@
 from allauth.account.models import EmailAddress
 from django.contrib.auth import get_user, get_user_model
+from django.contrib.auth.models import Group
+from django.core import mail
 from django.test import TestCase
 from django.urls import reverse
 
@@ -84,3 +86,44 @@ class ProfileTest(TestCase):
         self.assertEqual(self.user.email, updated_user_data["email"])
         self.assertEqual(self.user.phone, updated_user_data["phone"])
         self.assertEqual(self.user.address, updated_user_data["address"])
+
+
+class GroupAdminTest(TestCase):
+    def setUp(self):
+        self.client.force_login(
+            get_user_model().objects.create_superuser(username="admin")
+        )
+        self.group = Group.objects.create(name="group")
+        self.members = [
+            get_user_model().objects.create_user(
+                username=f"user{i}", email=f"user{i}@baskets.com"
+            )
+            for i in range(2)
+        ]
+        self.group.user_set.set(self.members)
+        get_user_model().objects.create_user(
+            username="other", email="other@baskets.com"
+        )
+
+    def test_email_group_members(self):
+        action_data = {
+            "action": "email_group_members",
+            "_selected_action": [self.group.id],
+        }
+
+        # form to write message
+        response = self.client.post(reverse("admin:auth_group_changelist"), action_data)
+        self.assertTemplateUsed(response, "admin/email_users.html")
+        self.assertEqual(len(mail.outbox), 0)
+
+        response = self.client.post(
+            reverse("admin:auth_group_changelist"),
+            {**action_data, "apply": "", "subject": "Subject", "message": "Message"},
+            follow=True,
+        )
+        self.assertContains(response, "2 users have been notified by email")
+        self.assertEqual(
+            sorted(email.to for email in mail.outbox),
+            [[member.email] for member in self.members],
+        )
+        self.assertIn("Message", mail.outbox[0].body)
@@ -0,0 +1,74 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:29
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdempotencyKey",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255, verbose_name="key")),
+                (
+                    "request_method",
+                    models.CharField(max_length=8, verbose_name="request method"),
+                ),
+                (
+                    "request_path",
+                    models.CharField(max_length=255, verbose_name="request path"),
+                ),
+                (
+                    "response_status",
+                    models.PositiveSmallIntegerField(
+                        null=True, verbose_name="response status"
+                    ),
+                ),
+                (
+                    "response_data",
+                    models.JSONField(null=True, verbose_name="response data"),
+                ),
+                (
+                    "creation_date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="creation date"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="idempotency_keys",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="user",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "idempotency key",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="idempotencykey",
+            constraint=models.UniqueConstraint(
+                fields=("user", "key"), name="unique idempotency key"
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idempotencykey",
+            name="request_hash",
+            field=models.CharField(
+                default="", max_length=64, verbose_name="request hash"
+            ),
+        ),
+    ]
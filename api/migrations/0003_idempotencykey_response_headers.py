@@ -0,0 +1,17 @@
+# Generated by Django 3.2.20 on 2026-10-17 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0002_idempotencykey_request_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="idempotencykey",
+            name="response_headers",
+            field=models.JSONField(default=dict, verbose_name="response headers"),
+        ),
+    ]
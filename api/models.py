@@ -0,0 +1,111 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import UniqueConstraint
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class IdempotencyKey(models.Model):
+    """Response to a user request sent with an 'Idempotency-Key' header, replayed on retries (see run_idempotent)"""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        on_delete=models.CASCADE,
+        related_name="idempotency_keys",
+    )
+    key = models.CharField(_("key"), max_length=255)
+    request_method = models.CharField(_("request method"), max_length=8)
+    request_path = models.CharField(_("request path"), max_length=255)
+    request_hash = models.CharField(_("request hash"), max_length=64, default="")
+    response_status = models.PositiveSmallIntegerField(_("response status"), null=True)
+    response_headers = models.JSONField(_("response headers"), default=dict)
+    response_data = models.JSONField(_("response data"), null=True)
+    creation_date = models.DateTimeField(_("creation date"), default=timezone.now)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["user", "key"], name="unique idempotency key")
+        ]
+        verbose_name = _("idempotency key")
+
+    # response headers stored with the key, to be sent again on replays
+    REPLAYED_HEADERS = ["ETag", "Location"]
+
+    @classmethod
+    def run_idempotent(cls, request, handler):
+        """Return handler() response, or the stored one if request was already handled with same key.
+
+        Key row is locked until response is stored, so concurrent duplicates wait for the first one and then replay
+        its response. Responses are kept for IDEMPOTENCY_KEYS_TTL seconds. A key reused for a request with another
+        method, path or body is rejected.
+        """
+
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return handler()
+
+        request_hash = cls.get_request_hash(request)
+        expiration_date = timezone.now() - timedelta(
+            seconds=settings.IDEMPOTENCY_KEYS_TTL
+        )
+        with transaction.atomic():
+            record, created = cls.objects.select_for_update().get_or_create(
+                user=request.user,
+                key=key[: cls._meta.get_field("key").max_length],
+                defaults={
+                    "request_method": request.method,
+                    "request_path": request.path,
+                    "request_hash": request_hash,
+                },
+            )
+            if created:
+                cls.objects.filter(creation_date__lt=expiration_date).delete()
+            elif record.creation_date < expiration_date:
+                # expired: handle request as a new one
+                record.request_method = request.method
+                record.request_path = request.path
+                record.request_hash = request_hash
+                record.creation_date = timezone.now()
+            elif record.request_hash != request_hash:
+                return Response(
+                    data={
+                        "message": "Idempotency-Key already used for another request"
+                    },
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            else:
+                return Response(
+                    data=record.response_data,
+                    status=record.response_status,
+                    headers={
+                        **record.response_headers,
+                        "Idempotent-Replayed": "true",
+                    },
+                )
+
+            response = handler()
+            record.response_status = response.status_code
+            record.response_headers = {
+                header: response[header]
+                for header in cls.REPLAYED_HEADERS
+                if response.has_header(header)
+            }
+            record.response_data = response.data
+            record.save()
+            return response
+
+    @staticmethod
+    def get_request_hash(request):
+        """Hash of request method, path and (parsed) body"""
+
+        body = json.dumps(request.data, sort_keys=True, default=str)
+        return hashlib.sha256(
+            f"{request.method} {request.path} {body}".encode()
+        ).hexdigest()
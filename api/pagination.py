@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OrderCursorPagination(CursorPagination):
+    """Keyset pagination of user orders, latest delivery first (a user has at most one order per delivery date).
+
+    Queryset must be annotated with 'delivery_date', as cursor position is read from an instance attribute.
+    """
+
+    ordering = "-delivery_date"
+    page_size = 20
@@ -1,7 +1,17 @@
+from itertools import groupby
+from operator import attrgetter
+
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from rest_framework import serializers
-from rest_framework.fields import empty
 
-from baskets.models import Delivery, Order, OrderItem, Producer, Product
+from baskets.models import (
+    Delivery,
+    Order,
+    OrderItem,
+    Producer,
+    Product,
+)
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -11,23 +21,14 @@ class ProductSerializer(serializers.ModelSerializer):
 
 
 class ProducerSerializer(serializers.ModelSerializer):
-    products = serializers.SerializerMethodField()
+    """Producer with the given products only, set on its `delivery_products` attribute"""
+
+    products = ProductSerializer(source="delivery_products", many=True)
 
     class Meta:
         model = Producer
         fields = ["name", "products"]
 
-    def get_products(self, obj):
-        queryset = obj.products.all()
-        if self.products_filter:
-            queryset = obj.products.filter(id__in=self.products_filter)
-        serializer = ProductSerializer(queryset, many=True)
-        return serializer.data
-
-    def __init__(self, instance=None, data=empty, products_filter=None, **kwargs):
-        super().__init__(instance, data, **kwargs)
-        self.products_filter = products_filter
-
 
 class DeliverySerializer(serializers.ModelSerializer):
     class Meta:
@@ -35,6 +36,20 @@ class DeliverySerializer(serializers.ModelSerializer):
         fields = ["url", "date", "order_deadline"]
 
 
+def prefetch_catalog(deliveries):
+    """Fetch products of all given deliveries, with their producer, in a single query"""
+
+    prefetch_related_objects(
+        deliveries,
+        Prefetch(
+            "products",
+            queryset=Product.objects.select_related("producer").order_by(
+                "producer__name", "producer", "name"
+            ),
+        ),
+    )
+
+
 class DeliveryDetailSerializer(serializers.ModelSerializer):
     products_by_producer = serializers.SerializerMethodField()
 
@@ -43,17 +58,36 @@ class DeliveryDetailSerializer(serializers.ModelSerializer):
         fields = ["id", "date", "order_deadline", "products_by_producer", "message"]
 
     def get_products_by_producer(self, obj):
+        """Group delivery products by producer, using a single query (none if they have been prefetched with
+        prefetch_catalog)"""
+
+        if "products" not in getattr(obj, "_prefetched_objects_cache", {}):
+            prefetch_catalog([obj])
         delivery_products = obj.products.all()
-        delivery_producers = Producer.objects.filter(
-            products__in=delivery_products
-        ).distinct()
-        serializer = ProducerSerializer(
-            delivery_producers, many=True, products_filter=delivery_products
-        )
-        return serializer.data
+        producers = []
+        for producer, products in groupby(
+            delivery_products, key=attrgetter("producer")
+        ):
+            producer.delivery_products = list(products)
+            producers.append(producer)
+        return ProducerSerializer(producers, many=True).data
+
+
+class ProductField(serializers.PrimaryKeyRelatedField):
+    """Product primary key, looked up in order items products when they have been fetched at once (see
+    OrderDetailSerializer.to_internal_value)"""
+
+    def to_internal_value(self, data):
+        try:
+            return self.context["items_products"][int(data)]
+        except (KeyError, TypeError, ValueError):
+            return super().to_internal_value(data)  # raises validation errors
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
+    product = ProductField(
+        queryset=Product.objects.all(), allow_null=True, required=False
+    )
     read_only_fields = ["product_name", "product_unit_price", "amount"]
 
     class Meta:
@@ -77,13 +111,29 @@ class OrderDetailSerializer(serializers.ModelSerializer):
         model = Order
         fields = ["url", "delivery", "items", "amount", "message", "is_open"]
 
+    def to_internal_value(self, data):
+        """Fetch products of all items in a single query"""
+
+        items = data.get("items") if isinstance(data, dict) else None
+        if isinstance(items, list):
+            product_ids = {
+                int(item["product"])
+                for item in items
+                if isinstance(item, dict) and str(item.get("product")).isdigit()
+            }
+            self.context["items_products"] = Product.objects.in_bulk(product_ids)
+        return super().to_internal_value(data)
+
     def validate_delivery(self, value):
         if not value.is_open:
             raise serializers.ValidationError(
                 "Delivery closed (order deadline is past)"
             )
         # only for "create" action
-        if not self.instance and value.orders.filter(user=self.context["request"].user):
+        if (
+            not self.instance
+            and value.orders.filter(user=self.context["request"].user).exists()
+        ):
             raise serializers.ValidationError(
                 "You have already an order for this delivery"
             )
@@ -92,39 +142,55 @@ class OrderDetailSerializer(serializers.ModelSerializer):
     def validate_items(self, value):
         if not value:
             raise serializers.ValidationError("Order must contain at least one item")
+        products = [item["product"] for item in value if item.get("product")]
+        if len(set(products)) < len(products):
+            raise serializers.ValidationError(
+                "Each product can only be in one item of the order"
+            )
         return value
 
     def validate(self, data):
         """Check that all items are available on delivery"""
 
-        for item in data["items"]:
-            product = item["product"]
-            if product not in data["delivery"].products.all():
-                raise serializers.ValidationError(
-                    {"items": f"Product '{product}' not available in delivery"}
-                )
+        unavailable_products = data["delivery"].get_unavailable_products(
+            item["product"] for item in data["items"]
+        )
+        if unavailable_products:
+            raise serializers.ValidationError(
+                {
+                    "items": "Products not available in delivery: {}".format(
+                        ", ".join(f"'{p}'" for p in unavailable_products)
+                    )
+                }
+            )
         return data
 
     def create(self, validated_data):
         # Validations are done before create
         items_data = validated_data.pop("items")
-        order = Order.objects.create(
-            user=self.context["request"].user, **validated_data
+        order = Order(user=self.context["request"].user, **validated_data)
+        items = order.update_items(
+            {item["product"]: item["quantity"] for item in items_data}
         )
-        for item_data in items_data:
-            order.items.create(**item_data)
+        _cache_items(order, items)
         return order
 
     def update(self, instance, validated_data):
-        # remove previous items, before instance.save() otherwise we get `save() prohibited` error
-        for item in instance.items.all():
-            item.delete()
+        with transaction.atomic():
+            instance.delivery = validated_data.get("delivery", instance.delivery)
+            instance.message = validated_data.get("message", instance.message)
+            instance.save()
+            instance.update_items(
+                {item["product"]: item["quantity"] for item in validated_data["items"]}
+            )
 
-        instance.delivery = validated_data.get("delivery", instance.delivery)
-        instance.message = validated_data.get("message", instance.message)
-        instance.save()
+        return instance
 
-        for item_data in validated_data["items"]:
-            instance.items.create(**item_data)
 
-        return instance
+def _cache_items(order, items):
+    """Cache order items as if they had been prefetched, so that they're not fetched again for the response"""
+
+    queryset = OrderItem.objects.filter(order=order)
+    queryset._result_cache = items
+    queryset._prefetch_done = True
+    order._prefetched_objects_cache = {"items": queryset}
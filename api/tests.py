@@ -1,7 +1,14 @@
 import json
+from datetime import timedelta
+from unittest.mock import patch
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.db.models import Max
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 
@@ -15,6 +22,10 @@ from baskets.tests.common import (
     create_user,
 )
 
+from .models import IdempotencyKey
+from .pagination import OrderCursorPagination
+from .views import OrderViewSet
+
 SERVER_NAME = "http://testserver"
 
 
@@ -57,6 +68,11 @@ def get_delivery_detail_json(delivery):
     }
 
 
+def get_order_etag(order):
+    order.refresh_from_db()
+    return OrderViewSet.get_etag(order)
+
+
 def get_order_json(order):
     return {
         "url": SERVER_NAME + reverse("order-detail", args=[order.id]),
@@ -128,6 +144,61 @@ class TestDeliveryAPI(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.json(), get_delivery_detail_json(delivery))
 
+    def test_retrieve_queries_count_doesnt_depend_on_producers_count(self):
+        def get_queries_count():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse("delivery-detail", args=[delivery.id]))
+            return len(ctx.captured_queries)
+
+        delivery = create_opened_delivery()
+        self.client.force_authenticate(user=create_user())
+        queries_count = get_queries_count()
+
+        for _ in range(3):
+            delivery.products.add(
+                *[create_product(producer=create_producer()) for _ in range(2)]
+            )
+            self.assertEqual(get_queries_count(), queries_count)
+
+    def test_retrieve_cached_until_catalog_changes(self):
+        product = create_product()
+        delivery = create_opened_delivery(products=[product])
+        url = reverse("delivery-detail", args=[delivery.id])
+        self.client.force_authenticate(user=create_user())
+        self.client.get(url)
+
+        with self.assertNumQueries(1):  # only delivery lookup
+            response = self.client.get(url)
+        self.assertEqual(response.json(), get_delivery_detail_json(delivery))
+
+        product.unit_price += 1
+        product.save()
+        response = self.client.get(url)
+        self.assertEqual(response.json(), get_delivery_detail_json(delivery))
+
+        delivery.products.add(create_product())
+        response = self.client.get(url)
+        self.assertEqual(response.json(), get_delivery_detail_json(delivery))
+
+    def test_retrieve_not_modified(self):
+        product = create_product()
+        delivery = create_opened_delivery(products=[product])
+        url = reverse("delivery-detail", args=[delivery.id])
+        self.client.force_authenticate(user=create_user())
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertFalse(response.content)
+
+        product.name = "new name"
+        product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json(), get_delivery_detail_json(delivery))
+
     def test_retrieve_not_authenticated(self):
         delivery = create_opened_delivery()
         response = self.client.get(reverse("delivery-detail", args=[delivery.id]))
@@ -165,7 +236,7 @@ class TestOrderAPI(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(
-            response.json(),
+            response.json()["results"],
             [
                 get_order_json(o)
                 for o in sorted(
@@ -174,6 +245,32 @@ class TestOrderAPI(APITestCase):
             ],
         )
 
+    @patch.object(OrderCursorPagination, "page_size", 2)
+    def test_list_pages(self):
+        """Check that closed orders can be listed page by page, with a constant queries count"""
+
+        self.user = create_user()
+        self._create_opened_and_closed_orders()
+        closed_orders = sorted(
+            [o for o in self.orders if not o.is_open],
+            key=lambda x: x.delivery.date,
+            reverse=True,
+        )
+
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url_list, {"is_open": "false"})
+        first_page = response.json()
+        with self.assertNumQueries(1):
+            response = self.client.get(first_page["next"])
+        second_page = response.json()
+
+        self.assertEqual(
+            first_page["results"] + second_page["results"],
+            [get_order_json(o) for o in closed_orders],
+        )
+        self.assertIsNone(second_page["next"])
+
     def test_list_not_authenticated(self):
         response = self.client.get(self.url_list)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -213,6 +310,107 @@ class TestOrderAPI(APITestCase):
         self.assertEqual(new_order.message, message)
         self.assertEqual(new_order.items.count(), 2)
 
+    def test_create_queries_count(self):
+        products = [create_product() for _ in range(20)]
+        delivery = create_opened_delivery(products=products)
+        payload = {
+            "delivery": delivery.id,
+            "items": [{"product": p.id, "quantity": 2} for p in products],
+        }
+        self.client.force_authenticate(user=create_user())
+
+        # products, delivery, existing user order, products availability, savepoint, order, items,
+        # product totals, release
+        with self.assertNumQueries(9):
+            response = self.client.post(
+                self.url_list,
+                data=json.dumps(payload),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get()
+        self.assertEqual(response.json(), get_order_detail_json(order))
+
+    def test_create_idempotency_key(self):
+        user = create_user()
+        delivery = create_opened_delivery()
+        self.client.force_authenticate(user=user)
+        payload = {
+            "delivery": delivery.id,
+            "items": [{"product": delivery.products.first().id, "quantity": 1}],
+        }
+
+        def post(key, data=payload):
+            return self.client.post(
+                self.url_list,
+                data=json.dumps(data),
+                content_type="application/json",
+                HTTP_IDEMPOTENCY_KEY=key,
+            )
+
+        response1 = post("key1")
+        with self.assertNumQueries(3):  # savepoint, locked key select, release
+            response2 = post("key1")
+
+        self.assertEqual(response1.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response2.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response2.json(), response1.json())
+        self.assertEqual(response2["Idempotent-Replayed"], "true")
+        self.assertEqual(response2["ETag"], response1["ETag"])
+        self.assertEqual(response2["Location"], response1["Location"])
+        self.assertEqual(user.orders.count(), 1)
+
+        # with another key, request is handled again
+        response3 = post("key2")
+        self.assertEqual(response3.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # key used for another payload
+        response = post(
+            "key1",
+            {**payload, "items": [{**payload["items"][0], "quantity": 2}]},
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(user.orders.count(), 1)
+
+        # key used for another request
+        response = self.client.put(
+            response1.json()["url"],
+            data=json.dumps(payload),
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="key1",
+        )
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_create_idempotency_key_expired(self):
+        user = create_user()
+        delivery = create_opened_delivery()
+        self.client.force_authenticate(user=user)
+        IdempotencyKey.objects.create(
+            user=user,
+            key="key",
+            request_method="POST",
+            request_path=str(self.url_list),
+            response_status=status.HTTP_400_BAD_REQUEST,
+            response_data={},
+            creation_date=timezone.now()
+            - timedelta(seconds=settings.IDEMPOTENCY_KEYS_TTL + 1),
+        )
+        payload = {
+            "delivery": delivery.id,
+            "items": [{"product": delivery.products.first().id, "quantity": 1}],
+        }
+
+        response = self.client.post(
+            self.url_list,
+            data=json.dumps(payload),
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY="key",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(user.orders.count(), 1)
+
     def test_create_not_authenticated(self):
         orders_count_initial = Order.objects.count()
 
@@ -326,6 +524,27 @@ class TestOrderAPI(APITestCase):
         self.assertIn("items", response.json())
         self.assertEqual(user.orders.count(), 0)
 
+    def test_create_products_not_in_delivery_single_error(self):
+        user = create_user()
+        products = [create_product() for _ in range(3)]
+        delivery = create_opened_delivery(products=[products[0]])
+
+        self.client.force_authenticate(user=user)
+        payload = {
+            "delivery": delivery.id,
+            "items": [{"product": p.id, "quantity": 1} for p in products],
+        }
+        response = self.client.post(
+            self.url_list, data=json.dumps(payload), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()["items"]
+        self.assertEqual(len(errors), 1)
+        self.assertNotIn(str(products[0]), errors[0])
+        self.assertIn(str(products[1]), errors[0])
+        self.assertIn(str(products[2]), errors[0])
+
     def test_retrieve(self):
         """Check that user can retrieve its orders (opened and closed)"""
 
@@ -347,6 +566,26 @@ class TestOrderAPI(APITestCase):
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(response.json(), get_order_detail_json(order))
 
+    def test_retrieve_not_modified(self):
+        user = create_user()
+        order_item = create_order_item(delivery=create_opened_delivery(), user=user)
+        url = reverse("order-detail", args=[order_item.order.id])
+        self.client.force_authenticate(user=user)
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertFalse(response.content)
+
+        # order is modified
+        order_item.quantity += 1
+        order_item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json(), get_order_detail_json(order_item.order))
+
     def test_retrieve_invalid_user(self):
         user1 = create_user()
         user2 = create_user()
@@ -385,6 +624,7 @@ class TestOrderAPI(APITestCase):
             reverse("order-detail", args=[opened_order.id]),
             data=json.dumps(payload),
             content_type="application/json",
+            HTTP_IF_MATCH=get_order_etag(opened_order),
         )
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -398,6 +638,105 @@ class TestOrderAPI(APITestCase):
         self.assertEqual(updated_order.items.first().product, products[1])
         self.assertEqual(updated_order.items.first().quantity, 3)
 
+    def test_update_delivery(self):
+        """Check that product totals of both previous and new deliveries are updated when order moves"""
+
+        user = create_user()
+        product = create_product()
+        previous_delivery, new_delivery = [
+            create_opened_delivery(products=[product]) for _ in range(2)
+        ]
+        order_item = create_order_item(
+            delivery=previous_delivery, product=product, user=user
+        )
+
+        self.client.force_authenticate(user=user)
+        payload = {
+            "delivery": new_delivery.id,
+            "items": [{"product": product.id, "quantity": 2}],
+        }
+        response = self.client.put(
+            reverse("order-detail", args=[order_item.order.id]),
+            data=json.dumps(payload),
+            content_type="application/json",
+            HTTP_IF_MATCH=get_order_etag(order_item.order),
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(previous_delivery.product_totals.exists())
+        self.assertEqual(
+            list(
+                new_delivery.product_totals.values_list(
+                    "product", "total_quantity", "order_count"
+                )
+            ),
+            [(product.id, 2, 1)],
+        )
+
+    def test_update_duplicate_products(self):
+        user = create_user()
+        order_item = create_order_item(delivery=create_opened_delivery(), user=user)
+        product_id = order_item.product.id
+
+        self.client.force_authenticate(user=user)
+        payload = {
+            "delivery": order_item.order.delivery.id,
+            "items": [
+                {"product": product_id, "quantity": 1},
+                {"product": product_id, "quantity": 2},
+            ],
+        }
+        response = self.client.put(
+            reverse("order-detail", args=[order_item.order.id]),
+            data=json.dumps(payload),
+            content_type="application/json",
+            HTTP_IF_MATCH=get_order_etag(order_item.order),
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("items", response.json())
+        order_item.refresh_from_db()
+        self.assertEqual(order_item.order.items.count(), 1)
+
+    def test_update_if_match(self):
+        user = create_user()
+        order_item = create_order_item(delivery=create_opened_delivery(), user=user)
+        url = reverse("order-detail", args=[order_item.order.id])
+        self.client.force_authenticate(user=user)
+        etag = self.client.get(url)["ETag"]
+
+        def put(quantity, **headers):
+            payload = {
+                "delivery": order_item.order.delivery.id,
+                "items": [{"product": order_item.product.id, "quantity": quantity}],
+            }
+            return self.client.put(
+                url,
+                data=json.dumps(payload),
+                content_type="application/json",
+                **headers,
+            )
+
+        response = put(5)
+        self.assertEqual(response.status_code, status.HTTP_428_PRECONDITION_REQUIRED)
+
+        response = put(5, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_etag = response["ETag"]
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(new_etag, self.client.get(url)["ETag"])
+
+        # update from a client which fetched the order before previous update
+        response = put(7, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        order_item.refresh_from_db()
+        self.assertEqual(order_item.quantity, 5)
+
+        response = self.client.delete(url, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.delete(url, HTTP_IF_MATCH=new_etag)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
     def test_update_not_authenticated(self):
         order_item = create_order_item(delivery=create_opened_delivery())
         initial_quantity = order_item.quantity
@@ -438,6 +777,7 @@ class TestOrderAPI(APITestCase):
             reverse("order-detail", args=[order_item.order.id]),
             data=json.dumps(payload),
             content_type="application/json",
+            HTTP_IF_MATCH=get_order_etag(order_item.order),
         )
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -464,6 +804,7 @@ class TestOrderAPI(APITestCase):
             reverse("order-detail", args=[order_item.order.id]),
             data=json.dumps(payload),
             content_type="application/json",
+            HTTP_IF_MATCH=get_order_etag(order_item.order),
         )
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -482,7 +823,10 @@ class TestOrderAPI(APITestCase):
         item2 = opened_order.items.create(product=products[1], quantity=2)
 
         self.client.force_authenticate(user=user)
-        response = self.client.delete(reverse("order-detail", args=[opened_order.id]))
+        response = self.client.delete(
+            reverse("order-detail", args=[opened_order.id]),
+            HTTP_IF_MATCH=get_order_etag(opened_order),
+        )
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertNotIn(opened_order, user.orders.all())
@@ -503,7 +847,65 @@ class TestOrderAPI(APITestCase):
         )
 
         self.client.force_authenticate(user=user)
-        response = self.client.delete(reverse("order-detail", args=[closed_order.id]))
+        response = self.client.delete(
+            reverse("order-detail", args=[closed_order.id]),
+            HTTP_IF_MATCH=get_order_etag(closed_order),
+        )
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn(closed_order, user.orders.all())
+
+
+class TestDashboardAPI(APITestCase):
+    url = reverse_lazy("dashboard")
+
+    def test_get(self):
+        user = create_user()
+        opened_deliveries = [create_opened_delivery() for _ in range(2)]
+        closed_delivery = create_closed_delivery()
+        order = create_order_item(delivery=opened_deliveries[1], user=user).order
+        create_order_item(delivery=closed_delivery, user=user)
+        # order from another user
+        create_order_item(delivery=opened_deliveries[0])
+
+        self.client.force_authenticate(user=user)
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "delivery": get_delivery_detail_json(opened_deliveries[0]),
+                    "order": None,
+                    "order_etag": None,
+                },
+                {
+                    "delivery": get_delivery_detail_json(opened_deliveries[1]),
+                    "order": get_order_detail_json(order),
+                    "order_etag": get_order_etag(order),
+                },
+            ],
+        )
+
+    def test_queries_count_doesnt_depend_on_deliveries_and_orders_count(self):
+        def get_queries_count():
+            cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(self.url)
+            return len(ctx.captured_queries)
+
+        user = create_user()
+        create_order_item(delivery=create_opened_delivery(), user=user)
+        self.client.force_authenticate(user=user)
+        queries_count = get_queries_count()
+
+        for _ in range(3):
+            delivery = create_opened_delivery()
+            delivery.products.add(create_product(producer=create_producer()))
+            create_order_item(delivery=delivery, user=user)
+            self.assertEqual(get_queries_count(), queries_count)
+
+    def test_get_not_authenticated(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
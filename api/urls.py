@@ -7,4 +7,7 @@ router = DefaultRouter()
 router.register(r"deliveries", views.DeliveryViewSet, "delivery")
 router.register(r"orders", views.OrderViewSet, "order")
 
-urlpatterns = [path("v1/", include(router.urls))]
+urlpatterns = [
+    path("v1/", include(router.urls)),
+    path("v1/dashboard/", views.DashboardView.as_view(), name="dashboard"),
+]
@@ -1,32 +1,89 @@
-from datetime import date
-
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import status, viewsets
+from rest_framework.exceptions import APIException
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from baskets.models import Delivery
+from baskets.cache import CATALOG_CACHE_TIMEOUT, get_catalog_version, get_or_build
+from baskets.models import Delivery, Order, get_opened_deliveries
 
+from .models import IdempotencyKey
+from .pagination import OrderCursorPagination
 from .serializers import (
     DeliveryDetailSerializer,
     DeliverySerializer,
     OrderDetailSerializer,
     OrderSerializer,
+    prefetch_catalog,
 )
 
 
+def _conditional_response(request, etag, get_data):
+    """Return a '304 Not Modified' response if request 'If-None-Match' header matches etag (so get_data() isn't
+    called), otherwise a response with get_data(). Both with ETag header"""
+
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in if_none_match or "*" in if_none_match:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(get_data())
+    response["ETag"] = etag
+    return response
+
+
+def _delivery_detail_cache_key(delivery_id, catalog_version):
+    return f"delivery_detail:{delivery_id}:{catalog_version}"
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = (
+        "Order has been modified meanwhile, 'If-Match' header doesn't match its ETag"
+    )
+    default_code = "precondition_failed"
+
+
+class PreconditionRequired(APIException):
+    status_code = status.HTTP_428_PRECONDITION_REQUIRED
+    default_detail = "'If-Match' header with order ETag is required"
+    default_code = "precondition_required"
+
+
 class DeliveryViewSet(viewsets.ReadOnlyModelViewSet):
     """Opened Deliveries API"""
 
     serializer_class = DeliverySerializer
     detail_serializer_class = DeliveryDetailSerializer
-    queryset = Delivery.objects.filter(order_deadline__gte=date.today()).order_by(
-        "date"
-    )
+
+    def get_queryset(self):
+        return Delivery.objects.opened()
 
     def get_serializer_class(self):
         if self.action == "retrieve":
             return self.detail_serializer_class
         return super().get_serializer_class()
 
+    def retrieve(self, request, *args, **kwargs):
+        """Delivery detail is the same for all users: serve it from cache, until catalog changes"""
+
+        delivery = self.get_object()
+        catalog_version = get_catalog_version()
+        return _conditional_response(
+            request,
+            quote_etag(f"{delivery.id}:{catalog_version}"),
+            lambda: get_or_build(
+                _delivery_detail_cache_key(delivery.id, catalog_version),
+                lambda: dict(self.get_serializer(delivery).data),
+            ),
+        )
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(get_opened_deliveries(), many=True)
+        return Response(serializer.data)
+
 
 class OrderViewSet(viewsets.ModelViewSet):
     """User orders API"""
@@ -34,14 +91,103 @@ class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     detail_serializer_class = OrderDetailSerializer
 
+    pagination_class = OrderCursorPagination
+
     def get_queryset(self):
-        return self.request.user.orders.all().order_by("-delivery__date")
+        """User orders. On list, they can be filtered with 'is_open' query parameter ('true' or 'false')"""
+
+        orders = self.request.user.orders.latest_delivery_first()
+        is_open = self.request.query_params.get("is_open")
+        if self.action == "list" and is_open == "true":
+            orders = orders.opened()
+        elif self.action == "list" and is_open == "false":
+            orders = orders.closed()
+        return orders
 
     def get_serializer_class(self):
         if self.action in ["retrieve", "create", "update"]:
             return self.detail_serializer_class
         return super().get_serializer_class()
 
+    def create(self, request, *args, **kwargs):
+        return IdempotencyKey.run_idempotent(
+            request,
+            lambda: self.add_etag(
+                super(OrderViewSet, self).create(request, *args, **kwargs)
+            ),
+        )
+
+    def update(self, request, *args, **kwargs):
+        return IdempotencyKey.run_idempotent(
+            request,
+            lambda: self.add_etag(
+                super(OrderViewSet, self).update(request, *args, **kwargs)
+            ),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        order = self.get_object()
+        return _conditional_response(
+            request,
+            self.get_etag(order),
+            lambda: self.get_serializer(order).data,
+        )
+
+    @staticmethod
+    def get_etag(order):
+        """Order ETag, from its version (incremented on every order change) and open status"""
+
+        return quote_etag(
+            f"{order.id}-{order.version}-{'open' if order.is_open else 'closed'}"
+        )
+
+    def get_object(self):
+        """On writes, require request 'If-Match' header to match order ETag (optimistic concurrency control)"""
+
+        order = super().get_object()
+        if self.request.method in ["PUT", "PATCH", "DELETE"]:
+            if_match = self.request.headers.get("If-Match")
+            if not if_match:
+                raise PreconditionRequired()
+            etags = parse_etags(if_match)
+            if "*" not in etags and self.get_etag(order) not in etags:
+                raise PreconditionFailed()
+        return order
+
+    @staticmethod
+    def claim_version(order):
+        """Increment order version if it's still the checked one, otherwise order has been concurrently modified"""
+
+        if not Order.objects.filter(pk=order.pk, version=order.version).update(
+            version=F("version") + 1
+        ):
+            raise PreconditionFailed()
+        order.version += 1
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        self.saved_order = serializer.instance
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            self.claim_version(serializer.instance)
+            serializer.save()
+        self.saved_order = serializer.instance
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            self.claim_version(instance)
+            instance.delete()
+
+    def add_etag(self, response):
+        """Add ETag of created or updated order, to be used in next update 'If-Match' header. Set before response is
+        stored with its Idempotency-Key, so that it's also sent on replays"""
+
+        saved_order = getattr(self, "saved_order", None)
+        if saved_order and status.is_success(response.status_code):
+            response["ETag"] = self.get_etag(saved_order)
+        return response
+
     def destroy(self, request, *args, **kwargs):
         """prevent closed orders deletion"""
 
@@ -53,3 +199,54 @@ class OrderViewSet(viewsets.ModelViewSet):
             )
         self.perform_destroy(order)
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class DashboardView(APIView):
+    """Opened deliveries detail and related user orders (if any, with their ETag) in a single response, with a fixed
+    number of queries"""
+
+    def get(self, request):
+        deliveries = get_opened_deliveries()
+        orders = {
+            order.delivery_id: order
+            for order in request.user.orders.filter(delivery__in=deliveries)
+            .select_related("delivery")
+            .prefetch_related("items")
+        }
+        dashboard = []
+        for delivery, delivery_detail in zip(
+            deliveries, self.get_deliveries_detail(deliveries)
+        ):
+            order = orders.get(delivery.id)
+            dashboard.append(
+                {
+                    "delivery": delivery_detail,
+                    "order": (
+                        OrderDetailSerializer(order, context={"request": request}).data
+                        if order
+                        else None
+                    ),
+                    "order_etag": OrderViewSet.get_etag(order) if order else None,
+                }
+            )
+        return Response(dashboard)
+
+    @staticmethod
+    def get_deliveries_detail(deliveries):
+        """Get deliveries detail from cache, missing ones are built together (catalogs fetched in one query)"""
+
+        catalog_version = get_catalog_version()
+        keys = [_delivery_detail_cache_key(d.id, catalog_version) for d in deliveries]
+        details = cache.get_many(keys)
+        missing = [d for d, key in zip(deliveries, keys) if key not in details]
+        if missing:
+            prefetch_catalog(missing)
+            built = {
+                _delivery_detail_cache_key(d.id, catalog_version): dict(
+                    DeliveryDetailSerializer(d).data
+                )
+                for d in missing
+            }
+            cache.set_many(built, CATALOG_CACHE_TIMEOUT)
+            details.update(built)
+        return [details[key] for key in keys]
@@ -1,30 +1,39 @@
 from datetime import date
 
-from django.contrib import admin, messages
+from django.contrib import admin
 from django.contrib.auth import get_user_model
-from django.db.models import Case, Count, Sum, When
+from django.db import transaction
+from django.db.models import Case, Count, OuterRef, Subquery, When
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
-from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
-from .models import Delivery, Order, OrderItem, Producer, Product
+from .email import (
+    email_order_changes,
+    email_users_response,
+    get_order_changes,
+    show_message_emails_held,
+)
+from .models import (
+    Delivery,
+    DeliveryProductTotal,
+    Order,
+    OrderItem,
+    OutboxEmail,
+    Producer,
+    Product,
+    batched_order_updates,
+    product_totals_updated,
+    recalculate_orders,
+)
 
 User = get_user_model()
 
 
-def show_message_email_users(request, status_message, user_id_list):
-    emails_str = ", ".join(
-        User.objects.filter(id__in=user_id_list).values_list("email", flat=True)
-    )
-    link_text = _("Email affected users")
-    messages.add_message(
-        request,
-        messages.SUCCESS,
-        mark_safe(
-            f"{status_message}<br>"
-            f"<a href='mailto:?bcc={emails_str}'>{link_text}</a>"
-        ),
+def describe_removed_item(item):
+    return _("'{}' is no longer available and has been removed").format(
+        item.product_name
     )
 
 
@@ -51,6 +60,28 @@ class ProducerAdmin(admin.ModelAdmin):
         else:
             return format_html(f"<strike>{producer.name}</strike>")
 
+    def save_model(self, request, obj, form, change):
+        """If producer is deactivated, its products are removed from opened orders: show a message"""
+
+        producer = obj
+        order_changes = {}
+        if not producer.is_active:
+            order_changes = get_order_changes(
+                OrderItem.objects.filter(
+                    product__producer=producer,
+                    order__delivery__order_deadline__gte=date.today(),
+                ),
+                describe_removed_item,
+            )
+        if producer.save():
+            show_message_emails_held(
+                request,
+                _("Products from '{}' have been removed from opened orders.").format(
+                    producer
+                ),
+                email_order_changes(order_changes),
+            )
+
     def save_formset(self, request, form, formset, change):
         """If a product is disabled or its unit_price changes, update related orders and show a message"""
 
@@ -60,25 +91,40 @@ class ProducerAdmin(admin.ModelAdmin):
         for product in products_new_or_updated:
             try:
                 product_from_db = Product.objects.get(pk=product.id)
-                if user_id_list := (product.save()):
-                    if product_from_db.is_active and not product.is_active:
-                        show_message_email_users(
-                            request,
-                            _(
-                                "Product '{}' has been removed from opened orders."
-                            ).format(product),
-                            user_id_list,
-                        )
-                    if product.unit_price != product_from_db.unit_price:
-                        show_message_email_users(
-                            request,
-                            _("Product '{}' has been updated on opened orders.").format(
-                                product
-                            ),
-                            user_id_list,
-                        )
             except Product.DoesNotExist:  # new product
                 product.save()
+                continue
+
+            opened_order_items = product.order_items.filter(
+                order__delivery__order_deadline__gte=date.today()
+            )
+            if product_from_db.is_active and not product.is_active:
+                status_message = _(
+                    "Product '{}' has been removed from opened orders."
+                ).format(product)
+                order_changes = get_order_changes(
+                    opened_order_items, describe_removed_item
+                )
+            elif product.unit_price != product_from_db.unit_price:
+                status_message = _(
+                    "Product '{}' has been updated on opened orders."
+                ).format(product)
+                order_changes = get_order_changes(
+                    opened_order_items,
+                    lambda item: _(
+                        "'{name}' unit price changed from {old} € to {new} €"
+                    ).format(
+                        name=product.name,
+                        old=product_from_db.unit_price,
+                        new=product.unit_price,
+                    ),
+                )
+            else:
+                order_changes = {}
+            if product.save() and order_changes:
+                show_message_emails_held(
+                    request, status_message, email_order_changes(order_changes)
+                )
         formset.save_m2m()
 
 
@@ -91,6 +137,18 @@ class DeliveryProductInline(admin.TabularInline):
     extra = 0
     can_delete = False
 
+    def get_queryset(self, request):
+        """Add total ordered quantity of each product, read from DeliveryProductTotal in the same query"""
+        qs = super().get_queryset(request)
+        qs = qs.select_related("product__producer").annotate(
+            total_quantity=Subquery(
+                DeliveryProductTotal.objects.filter(
+                    delivery=OuterRef("delivery"), product=OuterRef("product")
+                ).values("total_quantity")
+            )
+        )
+        return qs
+
     @admin.display(description=_("producer"))
     def producer(self, obj):
         return obj.product.producer
@@ -98,25 +156,19 @@ class DeliveryProductInline(admin.TabularInline):
     @admin.display(description=_("product"))
     def product_html(self, obj):
         return (
-            format_html(f"<b>{obj.product}</b>")
-            if obj.product.order_items.filter(order__delivery=obj.delivery)
-            else obj.product
+            format_html(f"<b>{obj.product}</b>") if obj.total_quantity else obj.product
         )
 
     @admin.display(description=_("total ordered quantity"))
     def total_ordered_quantity(self, obj):
-        d = obj.delivery
-        p = obj.product
-        order_items = p.order_items.filter(order__delivery=d)
-        total_quantity = order_items.aggregate(Sum("quantity"))["quantity__sum"]
         order_items_admin_url = (
             f"{reverse('admin:baskets_orderitem_changelist')}"
-            f"?order__delivery__id__exact={d.id}&product__id__exact={p.id}"
+            f"?order__delivery__id__exact={obj.delivery_id}&product__id__exact={obj.product_id}"
         )
 
         return (
-            format_html(f"<a href='{order_items_admin_url}'>{total_quantity}</a>")
-            if total_quantity
+            format_html(f"<a href='{order_items_admin_url}'>{obj.total_quantity}</a>")
+            if obj.total_quantity
             else 0
         )
 
@@ -126,12 +178,13 @@ class DeliveryProductInline(admin.TabularInline):
 
 
 @admin.action(description=_("Email users from selected deliveries"))
-def mailto_users_from_deliveries(modeladmin, request, queryset):
+def email_users_from_deliveries(modeladmin, request, queryset):
     deliveries = queryset
-    show_message_email_users(
+    return email_users_response(
+        modeladmin,
         request,
-        "",
-        User.objects.filter(orders__delivery__in=deliveries).values("id"),
+        deliveries,
+        User.objects.filter(orders__delivery__in=deliveries).distinct(),
     )
 
 
@@ -141,7 +194,7 @@ class DeliveryAdmin(admin.ModelAdmin):
     ordering = ["-date"]
     filter_horizontal = ("products",)
     inlines = [DeliveryProductInline]
-    actions = [mailto_users_from_deliveries]
+    actions = [email_users_from_deliveries]
 
     class Media:
         css = {"all": ("css/hide_admin_original.css",)}
@@ -196,10 +249,14 @@ class DeliveryAdmin(admin.ModelAdmin):
                     message_text = _(
                         "The following product(s) have been removed from opened orders:"
                     )
-                    show_message_email_users(
+                    show_message_emails_held(
                         request,
                         f"{message_text} <ul><li>{products_html_list}</li></ul>",
-                        related_order_items.values("order__user__id"),
+                        email_order_changes(
+                            get_order_changes(
+                                related_order_items, describe_removed_item
+                            )
+                        ),
                     )
 
     def formfield_for_manytomany(self, db_field, request, **kwargs):
@@ -306,13 +363,22 @@ class OrderAdmin(admin.ModelAdmin):
         else:
             yield closed_inline.get_formset(request, order), closed_inline
 
+    def save_related(self, request, form, formsets, change):
+        """Recalculate order amount and delivery product totals once, instead of on every item save"""
+        with batched_order_updates():
+            super().save_related(request, form, formsets, change)
+
     def delete_queryset(self, request, queryset):
-        """Show message to contact deleted order users"""
-        user_id_list = list(
-            queryset.values_list("user__id", flat=True)
-        )  # needs to convert into list, otherwise queryset will be empty after queryset.delete()
-        queryset.delete()
-        show_message_email_users(request, "", user_id_list)
+        """Notify users of deleted orders of opened deliveries by email"""
+        orders = list(queryset.select_related("user", "delivery"))
+        order_changes = {
+            order: [_("Your order has been deleted")]
+            for order in orders
+            if order.is_open
+        }  # fetched before queryset.delete()
+        with product_totals_updated([order.id for order in orders]):
+            queryset.delete()
+        show_message_emails_held(request, "", email_order_changes(order_changes))
 
 
 @admin.register(OrderItem)
@@ -339,4 +405,30 @@ class OrderItemAdmin(admin.ModelAdmin):
         """Don't show 'add' button"""
         return False
 
+    def delete_queryset(self, request, queryset):
+        """Recalculate orders of deleted items (deleting the ones left without items) and delivery product totals"""
+        order_ids = set(queryset.values_list("order", flat=True))
+        with transaction.atomic(), product_totals_updated(order_ids):
+            queryset.delete()
+            recalculate_orders(order_ids)
+
     # TODO: Fix custom OrderItem.save() not called on save
+
+
+@admin.action(description=_("Send selected emails"))
+def send_emails(modeladmin, request, queryset):
+    queryset.exclude(status=OutboxEmail.Status.SENDING).update(
+        status=OutboxEmail.Status.PENDING, attempts=0, next_attempt_date=timezone.now()
+    )
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ("subject", "to", "status", "attempts", "creation_date", "sent_date")
+    list_filter = ("status",)
+    readonly_fields = ("status", "attempts", "error", "creation_date", "sent_date")
+    actions = [send_emails]
+
+    def has_add_permission(self, request):
+        """Emails are only added by OutboxEmailBackend"""
+        return False
@@ -0,0 +1,98 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+CATALOG_VERSION_KEY = "catalog_version"
+CATALOG_CACHE_TIMEOUT = 24 * 60 * 60
+USER_ORDERS_VERSION_KEY = "user_orders_version"
+
+FILL_LOCK_TIMEOUT = 10  # max time (s) a cache entry build is expected to take
+FILL_WAIT_INTERVAL = 0.05
+
+
+def get_version(key):
+    """Return current version of cached data identified by key"""
+
+    version = cache.get(key)
+    if version is None:
+        # start from current time, so that a lost version never reuses the one of a stale entry
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    """Invalidate all cache entries built from a version of key at once"""
+
+    try:
+        cache.incr(key)
+    except ValueError:  # key doesn't exist (yet or anymore)
+        cache.add(key, time.time_ns(), None)
+
+
+def get_catalog_version():
+    """Return current version of catalog data (deliveries, products and producers)"""
+
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version(**kwargs):
+    """Invalidate all catalog cache entries at once, can be used as a signal receiver.
+
+    Version is bumped again on commit, as entries may have been built meanwhile from uncommitted data
+    """
+
+    bump_version(CATALOG_VERSION_KEY)
+    transaction.on_commit(lambda: bump_version(CATALOG_VERSION_KEY))
+
+
+def get_user_orders_version(user_id):
+    """Return current version of user orders data"""
+
+    return get_version(f"{USER_ORDERS_VERSION_KEY}:{user_id}")
+
+
+def bump_user_orders_version(user_id):
+    bump_version(f"{USER_ORDERS_VERSION_KEY}:{user_id}")
+
+
+def get_or_build(key, build, timeout=CATALOG_CACHE_TIMEOUT):
+    """Return cached value of key, calling build() to fill it on miss.
+
+    Fill is single-flight: only the caller holding the fill lock builds the value, concurrent ones wait for it (up to
+    FILL_LOCK_TIMEOUT, then they build it themselves). Lock relies on atomic cache.add(), ensured by local memory and
+    memcached backends but not by file-based one.
+    """
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = f"{key}:lock"
+    locked = cache.add(lock_key, True, FILL_LOCK_TIMEOUT)
+    if locked:
+        # value may have been set by a builder which released the lock since first get()
+        value = cache.get(key)
+        if value is not None:
+            cache.delete(lock_key)
+            return value
+    else:
+        deadline = time.monotonic() + FILL_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(FILL_WAIT_INTERVAL)
+            # lock is read first, as builder sets value before releasing it
+            builder_running = cache.get(lock_key) is not None
+            value = cache.get(key)
+            if value is not None:
+                return value
+            if not builder_running:  # builder failed
+                break
+
+    try:
+        value = build()
+        cache.set(key, value, timeout)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
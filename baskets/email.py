@@ -1,8 +1,27 @@
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
 from django.apps import apps
 from django.conf import settings
+from django.contrib import messages
+from django.contrib.admin import helpers
 from django.contrib.auth import get_user_model
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection as db_connection
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
+
+from .forms import EmailUsersForm
+from .models import OutboxEmail
+
+OUTBOX_SENDERS_LOCK_ID = 7412
 
 
 def email_staff(from_email, subject, message):
@@ -18,3 +37,195 @@ def email_staff(from_email, subject, message):
         reply_to=[from_email],
     )
     email.send()
+
+
+def _get_user_email(user, subject, template_name, context):
+    app_name = apps.get_app_config("baskets").verbose_name
+    return EmailMessage(
+        subject=f"[{app_name}] {subject}",
+        body=render_to_string(template_name, {"user": user, **context}),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+    )
+
+
+def email_users(users, subject, message):
+    """Send message to each user of users queryset (fetched with a single query), return number of emails sent"""
+
+    emails = [
+        _get_user_email(
+            user, subject, "baskets/email/message.txt", {"message": message}
+        )
+        for user in users.exclude(email="")
+    ]
+    return get_connection().send_messages(emails) or 0
+
+
+def show_message_users_emailed(request, status_message, emails_count):
+    emailed_text = ngettext(
+        "%(count)d user has been notified by email.",
+        "%(count)d users have been notified by email.",
+        emails_count,
+    ) % {"count": emails_count}
+    messages.add_message(
+        request, messages.SUCCESS, mark_safe(f"{status_message}<br>{emailed_text}")
+    )
+
+
+def show_message_emails_held(request, status_message, emails_count):
+    outbox_url = (
+        f"{reverse('admin:baskets_outboxemail_changelist')}"
+        f"?status__exact={OutboxEmail.Status.HELD}"
+    )
+    held_text = ngettext(
+        "%(count)d email to affected users is held for review in <a href='%(url)s'>outbox</a>.",
+        "%(count)d emails to affected users are held for review in <a href='%(url)s'>outbox</a>.",
+        emails_count,
+    ) % {"count": emails_count, "url": outbox_url}
+    messages.add_message(
+        request, messages.SUCCESS, mark_safe(f"{status_message}<br>{held_text}")
+    )
+
+
+def email_users_response(modeladmin, request, queryset, users):
+    """Admin action response: a form to write a message, sent by email to users on submit"""
+
+    form = EmailUsersForm(request.POST if "apply" in request.POST else None)
+    if form.is_valid():
+        emails_count = email_users(
+            users, form.cleaned_data["subject"], form.cleaned_data["message"]
+        )
+        show_message_users_emailed(request, "", emails_count)
+        return None  # back to change list
+
+    return TemplateResponse(
+        request,
+        "admin/email_users.html",
+        {
+            **modeladmin.admin_site.each_context(request),
+            "title": _("Email users"),
+            "opts": modeladmin.model._meta,
+            "form": form,
+            "queryset": queryset,
+            "users_count": users.count(),
+            "action": request.POST["action"],
+            "action_checkbox_name": helpers.ACTION_CHECKBOX_NAME,
+        },
+    )
+
+
+def email_order_changes(order_changes):
+    """Hold in outbox an email to user of each order, with the changes applied to it given as
+    {order: [change description]} (see get_order_changes). Staff review them from outbox admin, then send them with
+    'Send selected emails' action or delete them. Return number of emails held"""
+
+    emails = [
+        OutboxEmail.from_message(
+            _get_user_email(
+                order.user,
+                _("Your order has been updated"),
+                "baskets/email/order_changes.txt",
+                {"delivery": order.delivery, "changes": changes},
+            ),
+            status=OutboxEmail.Status.HELD,
+        )
+        for order, changes in order_changes.items()
+        if order.user.email
+    ]
+    return len(OutboxEmail.objects.bulk_create(emails))
+
+
+def get_order_changes(order_items, describe_change):
+    """Return {order: [describe_change(item)]} for given order items, fetched with their order, user and delivery
+    in a single query"""
+
+    order_changes = {}
+    for item in order_items.select_related("order__user", "order__delivery"):
+        order_changes.setdefault(item.order, []).append(describe_change(item))
+    return order_changes
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """Store messages in the outbox instead of sending them, so that sending doesn't slow down or break requests.
+    They're sent by `send_outbox_emails` command, using OUTBOX_EMAIL_BACKEND"""
+
+    def send_messages(self, email_messages):
+        emails = OutboxEmail.objects.bulk_create(
+            OutboxEmail.from_message(message) for message in email_messages
+        )
+        return len(emails)
+
+
+@contextmanager
+def sender_slot():
+    """Take one of OUTBOX_MAX_SENDERS sending slots for the block, so that no more than OUTBOX_MAX_SENDERS connections
+    to email server are open at once. Yield False if all slots are taken.
+    Slots are PostgreSQL advisory locks (released if sender dies), other databases don't limit senders
+    """
+
+    if db_connection.vendor != "postgresql":
+        yield True
+        return
+
+    with db_connection.cursor() as cursor:
+        for slot in range(settings.OUTBOX_MAX_SENDERS):
+            cursor.execute(
+                "SELECT pg_try_advisory_lock(%s, %s)", [OUTBOX_SENDERS_LOCK_ID, slot]
+            )
+            if cursor.fetchone()[0]:
+                break
+        else:
+            yield False
+            return
+    try:
+        yield True
+    finally:
+        with db_connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_unlock(%s, %s)", [OUTBOX_SENDERS_LOCK_ID, slot]
+            )
+
+
+def send_outbox_emails(batch_size):
+    """Send up to batch_size pending emails over a single connection. Return number of emails sent, or None if
+    OUTBOX_MAX_SENDERS senders are already sending"""
+
+    with sender_slot() as slot_taken:
+        if not slot_taken:
+            return None
+        return _send_outbox_batch(batch_size)
+
+
+def _send_outbox_batch(batch_size):
+    emails = OutboxEmail.claim_pending(batch_size)
+    if not emails:
+        return 0
+
+    connection = get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    try:
+        connection.open()
+    except Exception:
+        error = traceback.format_exc()
+        for email in emails:
+            email.set_failed(error)
+    else:
+        try:
+            for email in emails:
+                try:
+                    email.to_message(connection=connection).send()
+                    email.set_sent()
+                except Exception:
+                    email.set_failed(traceback.format_exc())
+        finally:
+            connection.close()
+
+    OutboxEmail.objects.bulk_update(
+        emails, ["status", "attempts", "next_attempt_date", "error", "sent_date"]
+    )
+    return sum(email.status == OutboxEmail.Status.SENT for email in emails)
+
+
+def delete_sent_emails(max_age=timedelta(days=7)):
+    OutboxEmail.objects.filter(
+        status=OutboxEmail.Status.SENT, sent_date__lt=timezone.now() - max_age
+    ).delete()
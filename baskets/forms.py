@@ -23,3 +23,12 @@ class ContactForm(Form):
             attrs={"class": "form-control", "rows": 6, "placeholder": _("Your message")}
         ),
     )
+
+
+class EmailUsersForm(Form):
+    """Message sent to users from admin actions (see email_users_response)"""
+
+    subject = CharField(label=_("Subject"), required=True)
+    message = CharField(
+        label=_("Message"), required=True, widget=Textarea(attrs={"rows": 10})
+    )
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from baskets.email import delete_sent_emails, send_outbox_emails
+from baskets.models import OutboxEmail
+
+
+class Command(BaseCommand):
+    help = "Send pending outbox emails in batches, each batch over a single connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Maximum number of emails sent over one connection",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5.0,
+            help="Seconds between two checks for pending emails",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit as soon as there are no more emails due for sending",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            # emails left being sent by a stopped sender are queued again
+            OutboxEmail.requeue_stale()
+
+            sent = send_outbox_emails(options["batch_size"])
+            if sent:
+                self.stdout.write(f"{sent} emails sent")
+            if not OutboxEmail.objects.filter(
+                status=OutboxEmail.Status.PENDING, next_attempt_date__lte=timezone.now()
+            ).exists():
+                if options["once"]:
+                    break
+                delete_sent_emails()
+                time.sleep(options["interval"])
+            elif sent is None:  # OUTBOX_MAX_SENDERS senders already sending
+                time.sleep(options["interval"])
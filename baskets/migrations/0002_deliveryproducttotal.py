@@ -0,0 +1,93 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_delivery_product_totals(apps, schema_editor):
+    DeliveryProductTotal = apps.get_model("baskets", "DeliveryProductTotal")
+    OrderItem = apps.get_model("baskets", "OrderItem")
+    totals = (
+        OrderItem.objects.filter(product__isnull=False)
+        .order_by()
+        .values("order__delivery", "product")
+        .annotate(
+            total_quantity=Sum("quantity"), order_count=Count("order", distinct=True)
+        )
+    )
+    DeliveryProductTotal.objects.bulk_create(
+        DeliveryProductTotal(
+            delivery_id=total["order__delivery"],
+            product_id=total["product"],
+            total_quantity=total["total_quantity"],
+            order_count=total["order_count"],
+        )
+        for total in totals
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("baskets", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeliveryProductTotal",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "total_quantity",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="total quantity"
+                    ),
+                ),
+                (
+                    "order_count",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="number of orders"
+                    ),
+                ),
+                (
+                    "delivery",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="product_totals",
+                        to="baskets.delivery",
+                        verbose_name="delivery",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="delivery_totals",
+                        to="baskets.product",
+                        verbose_name="product",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "delivery product total",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="deliveryproducttotal",
+            constraint=models.UniqueConstraint(
+                fields=("delivery", "product"), name="one total per delivery product"
+            ),
+        ),
+        migrations.RunPython(
+            populate_delivery_product_totals, migrations.RunPython.noop
+        ),
+    ]
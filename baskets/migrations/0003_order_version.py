@@ -0,0 +1,19 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("baskets", "0002_deliveryproducttotal"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="order",
+            name="version",
+            field=models.PositiveIntegerField(
+                default=1, editable=False, verbose_name="version"
+            ),
+        ),
+    ]
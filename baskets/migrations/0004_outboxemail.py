@@ -0,0 +1,87 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:42
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("baskets", "0003_order_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEmail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("subject", models.TextField(verbose_name="subject")),
+                ("body", models.TextField(blank=True, verbose_name="body")),
+                ("html_body", models.TextField(blank=True, verbose_name="HTML body")),
+                ("from_email", models.CharField(max_length=255, verbose_name="from")),
+                ("to", models.JSONField(default=list, verbose_name="to")),
+                ("cc", models.JSONField(default=list, verbose_name="cc")),
+                ("bcc", models.JSONField(default=list, verbose_name="bcc")),
+                ("reply_to", models.JSONField(default=list, verbose_name="reply to")),
+                ("headers", models.JSONField(default=dict, verbose_name="headers")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "pending"),
+                            ("sending", "sending"),
+                            ("sent", "sent"),
+                            ("failed", "failed"),
+                        ],
+                        default="pending",
+                        max_length=16,
+                        verbose_name="status",
+                    ),
+                ),
+                (
+                    "attempts",
+                    models.PositiveSmallIntegerField(
+                        default=0, verbose_name="attempts"
+                    ),
+                ),
+                (
+                    "next_attempt_date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now,
+                        verbose_name="next attempt date",
+                    ),
+                ),
+                ("error", models.TextField(blank=True, verbose_name="error")),
+                (
+                    "creation_date",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="creation date"
+                    ),
+                ),
+                (
+                    "sent_date",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="sent date"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "outbox email",
+                "ordering": ["creation_date"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="outboxemail",
+            index=models.Index(
+                fields=["status", "next_attempt_date"],
+                name="baskets_out_status_ef3a40_idx",
+            ),
+        ),
+    ]
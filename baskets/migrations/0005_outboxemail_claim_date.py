@@ -0,0 +1,19 @@
+# Generated by Django 3.2.20 on 2026-10-17 01:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("baskets", "0004_outboxemail"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxemail",
+            name="claim_date",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="claim date"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.20 on 2026-10-17 01:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("baskets", "0005_outboxemail_claim_date"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="outboxemail",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "pending"),
+                    ("held", "held for review"),
+                    ("sending", "sending"),
+                    ("sent", "sent"),
+                    ("failed", "failed"),
+                ],
+                default="pending",
+                max_length=16,
+                verbose_name="status",
+            ),
+        ),
+    ]
@@ -1,16 +1,37 @@
+import operator
+import threading
+from contextlib import contextmanager, nullcontext
 from datetime import date, timedelta
+from decimal import Decimal
+from functools import reduce
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Sum, UniqueConstraint
-from django.db.models.signals import m2m_changed
+from django.db import connection, models, transaction
+from django.db.models import (
+    Count,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    UniqueConstraint,
+    Value,
+)
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from config.settings import FR_PHONE_REGEX
 
+from .cache import bump_catalog_version, bump_user_orders_version
+
 
 class Producer(models.Model):
     name = models.CharField(_("name"), blank=False, max_length=64)
@@ -30,9 +51,40 @@ class Producer(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if not self.is_active:
-            for product in self.products.all():
-                product.is_active = False
-                product.save()
+            return self.deactivate_products()
+
+    def deactivate_products(self):
+        """Deactivate all producer products and remove them from opened deliveries and orders, using set-based
+        statements. Return list of affected user ids"""
+
+        self.products.update(is_active=False)
+        return self.products.remove_from_opened_deliveries()
+
+
+class ProductQuerySet(models.QuerySet):
+    def remove_from_opened_deliveries(self):
+        """Remove products from opened deliveries and delete related opened order items (related orders are
+        recalculated), using set-based statements. Return list of affected user ids"""
+
+        today = date.today()
+        opened_order_items = OrderItem.objects.filter(
+            product__in=self, order__delivery__order_deadline__gte=today
+        )
+        affected_orders = list(
+            Order.objects.filter(items__in=opened_order_items)
+            .order_by()
+            .values_list("id", "user")
+            .distinct()
+        )
+        Delivery.products.through.objects.filter(
+            product__in=self, delivery__order_deadline__gte=today
+        ).delete()  # m2m_changed is not sent, so opened order items are deleted below
+        bump_catalog_version()
+        order_ids = {order_id for order_id, user_id in affected_orders}
+        with product_totals_updated(order_ids):
+            opened_order_items.delete()
+            recalculate_orders(order_ids)
+        return list({user_id for order_id, user_id in affected_orders})
 
 
 class Product(models.Model):
@@ -47,6 +99,8 @@ class Product(models.Model):
     )
     is_active = models.BooleanField(_("active"), default=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = _("product")
         ordering = ["producer", "name"]  # for "Next Orders" and "DeliveryAdmin" pages
@@ -59,36 +113,49 @@ class Product(models.Model):
         if self.is_active and not self.producer.is_active:
             self.producer.is_active = True
             self.producer.save()
-        opened_order_items_list, user_id_list = self._get_opened_order_items_and_users()
-        for oi in opened_order_items_list:
-            oi.save()
         if not self.is_active:
-            self._delete_from_opened_deliveries()
-        return user_id_list
+            return Product.objects.filter(pk=self.pk).remove_from_opened_deliveries()
+        return self.update_opened_order_items()
 
-    def _get_opened_order_items_and_users(self):
-        opened_order_items_list = [
-            oi for oi in self.order_items.all() if oi.order.is_open
-        ]
+    def update_opened_order_items(self):
+        """Update saved product data and amount of opened order items and recalculate related orders, using
+        set-based statements (no model instance is loaded). Return list of affected user ids
+        """
+
+        opened_order_items = self.order_items.filter(
+            order__delivery__order_deadline__gte=date.today()
+        )
         user_id_list = list(
-            get_user_model()
-            .objects.filter(orders__items__in=opened_order_items_list)
+            Order.objects.filter(items__in=opened_order_items)
+            .order_by()
+            .values_list("user", flat=True)
             .distinct()
-            .values_list("id", flat=True)
-        )  # use list(id) because User QuerySet would be empty when order_items are deleted
-        return opened_order_items_list, user_id_list
-
-    def _delete_from_opened_deliveries(self):
-        for d in Delivery.objects.filter(
-            products__in=[self], order_deadline__gte=date.today()
-        ):
-            d.products.remove(self)
+        )
+        if user_id_list:
+            opened_order_items.update(
+                product_name=self.name,
+                product_unit_price=self.unit_price,
+                amount=ExpressionWrapper(
+                    F("quantity") * self.unit_price,
+                    output_field=models.DecimalField(max_digits=8, decimal_places=2),
+                ),
+            )
+            Order.objects.filter(items__in=opened_order_items).update_amount()
+            clear_user_orders_cache(user_id_list)
+        return user_id_list
 
 
 class InactiveProductException(Exception):
     pass
 
 
+class DeliveryQuerySet(models.QuerySet):
+    def opened(self):
+        """Deliveries whose order deadline is not past, in chronological order"""
+
+        return self.filter(order_deadline__gte=date.today()).order_by("date")
+
+
 class Delivery(models.Model):
     ORDER_DEADLINE_DAYS_BEFORE = 4
     ORDER_DEADLINE_HELP_TEXT = _(
@@ -110,6 +177,8 @@ class Delivery(models.Model):
     )
     message = models.CharField(blank=True, max_length=128)
 
+    objects = DeliveryQuerySet.as_manager()
+
     class Meta:
         verbose_name = _("delivery")
         verbose_name_plural = _("deliveries")
@@ -126,15 +195,66 @@ class Delivery(models.Model):
     def is_open(self):
         return date.today() <= self.order_deadline
 
+    @cached_property
+    def product_ids(self):
+        """Ids of products available on delivery, fetched once per instance"""
+
+        return set(self.products.values_list("id", flat=True))
+
+    def get_unavailable_products(self, products):
+        """Return those of given products that aren't available on delivery"""
+
+        return [p for p in products if p is None or p.id not in self.product_ids]
+
     def __str__(self):
         return f"{self.date}"
 
 
+OPENED_DELIVERIES_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _opened_deliveries_cache_key():
+    # keyed by current date, so that deliveries are no longer served once their deadline is past
+    return f"opened_deliveries:{date.today().isoformat()}"
+
+
+def get_opened_deliveries():
+    """Return list of opened deliveries in chronological order, cached until a delivery changes"""
+
+    key = _opened_deliveries_cache_key()
+    deliveries = cache.get(key)
+    if deliveries is None:
+        deliveries = list(Delivery.objects.opened())
+        cache.set(key, deliveries, OPENED_DELIVERIES_CACHE_TIMEOUT)
+    return deliveries
+
+
+def clear_opened_deliveries_cache(**kwargs):
+    cache.delete(_opened_deliveries_cache_key())
+    # clear it again on commit, in case it has been filled meanwhile with uncommitted data
+    transaction.on_commit(lambda: cache.delete(_opened_deliveries_cache_key()))
+
+
+post_save.connect(clear_opened_deliveries_cache, sender=Delivery)
+post_delete.connect(clear_opened_deliveries_cache, sender=Delivery)
+m2m_changed.connect(clear_opened_deliveries_cache, sender=Delivery.products.through)
+
+# delivery detail (catalog) cache entries are invalidated on any delivery, product or producer change
+for sender in [Delivery, Product, Producer]:
+    post_save.connect(bump_catalog_version, sender=sender)
+    post_delete.connect(bump_catalog_version, sender=sender)
+m2m_changed.connect(bump_catalog_version, sender=Delivery.products.through)
+
+
 def delivery_product_removed(action, instance, pk_set, **kwargs):
     if action == "post_remove" and instance.is_open:
-        OrderItem.objects.filter(
+        order_items = OrderItem.objects.filter(
             product__id__in=pk_set, order__delivery=instance
-        ).delete()
+        )
+        order_ids = set(order_items.values_list("order", flat=True))
+        with product_totals_updated(order_ids):
+            order_items.delete()
+            recalculate_orders(order_ids)
 
 
 def delivery_product_add(action, instance, pk_set, **kwargs):
@@ -146,8 +266,50 @@ def delivery_product_add(action, instance, pk_set, **kwargs):
         raise InactiveProductException("Can't add inactive product to delivery")
 
 
+def delivery_products_changed(instance, **kwargs):
+    if isinstance(instance, Delivery):
+        instance.__dict__.pop("product_ids", None)  # clear cached_property
+
+
 m2m_changed.connect(delivery_product_removed, sender=Delivery.products.through)
 m2m_changed.connect(delivery_product_add, sender=Delivery.products.through)
+m2m_changed.connect(delivery_products_changed, sender=Delivery.products.through)
+
+
+class OrderQuerySet(models.QuerySet):
+    def opened(self):
+        return self.filter(delivery__order_deadline__gte=date.today())
+
+    def closed(self):
+        return self.filter(delivery__order_deadline__lt=date.today())
+
+    def latest_delivery_first(self):
+        """Orders with their delivery, latest delivery date (annotated as 'delivery_date') first"""
+
+        return (
+            self.select_related("delivery")
+            .annotate(delivery_date=F("delivery__date"))
+            .order_by("-delivery_date")
+        )
+
+    def update_amount(self):
+        """Recalculate amount of all orders in queryset from their items, using a single UPDATE statement"""
+
+        items_amount = (
+            OrderItem.objects.filter(order=OuterRef("pk"))
+            .values("order")
+            .annotate(total=Sum("amount"))
+            .values("total")
+        )
+        return self.update(
+            amount=Coalesce(
+                Subquery(items_amount),
+                Value(Decimal("0.00")),
+                output_field=models.DecimalField(max_digits=8, decimal_places=2),
+            ),
+            last_updated_date=timezone.now(),
+            version=F("version") + 1,
+        )
 
 
 class Order(models.Model):
@@ -173,6 +335,9 @@ class Order(models.Model):
         max_length=128,
         help_text=_("Internal message only visible by stuff members"),
     )
+    version = models.PositiveIntegerField(_("version"), default=1, editable=False)
+
+    objects = OrderQuerySet.as_manager()
 
     class Meta:
         constraints = [
@@ -184,11 +349,90 @@ class Order(models.Model):
         verbose_name = _("order")
 
     def save(self, *args, **kwargs):
-        order_items = self.items.all()
-        self.amount = (
-            order_items.aggregate(Sum("amount"))["amount__sum"] if order_items else 0.00
-        )
-        super().save(*args, **kwargs)
+        is_update = bool(self.pk)
+        # delivery the order is moved from, if any (also used by pre_save signal receivers)
+        self.previous_delivery = None
+        if is_update:
+            self.amount = self.items.aggregate(amount=Sum("amount"))["amount"] or 0
+            # incremented in database, as order may have been updated since this instance was fetched
+            self.version = F("version") + 1
+            self.previous_delivery = (
+                Delivery.objects.filter(orders=self.pk)
+                .exclude(pk=self.delivery_id)
+                .first()
+            )
+        # items move with the order: product totals of previous and new deliveries change
+        with (
+            product_totals_updated([self.pk])
+            if self.previous_delivery
+            else nullcontext()
+        ):
+            super().save(*args, **kwargs)
+        if is_update:
+            self.refresh_from_db(fields=["version"])
+
+    def delete(self, *args, **kwargs):
+        with product_totals_updated([self.id]):
+            return super().delete(*args, **kwargs)
+
+    def update_items(self, quantities):
+        """Set order items from given {product: quantity}, diffing them against existing items by product. Changes
+        are applied with one bulk create, one bulk update and one delete. Order amount and delivery product totals are
+        then updated from resulting items, without fetching them again. A new order is saved (with its amount) before
+        its items. Return resulting items
+        """
+
+        current_items = [] if self._state.adding else list(self.items.all())
+        product_totals = _get_items_product_totals(self.delivery_id, current_items)
+        items_by_product = {item.product_id: item for item in current_items}
+        new_items = []
+        updated_items = []
+        for product, quantity in quantities.items():
+            item = items_by_product.pop(product.id, None)
+            if item is None:
+                item = OrderItem(order=self, product=product, quantity=quantity)
+                new_items.append(item)
+            elif item.quantity != quantity:
+                item.product = product  # avoid fetching it again
+                item.quantity = quantity
+                updated_items.append(item)
+            else:
+                continue
+            item._update_saved_product_data()
+            item._update_amount()
+        deleted_items = list(items_by_product.values())
+        items = [item for item in current_items if item not in deleted_items]
+        items += new_items
+
+        with transaction.atomic():
+            if not items:
+                if not self._state.adding:
+                    self.delete()
+                return items
+            self.amount = sum(item.amount for item in items)
+            if self._state.adding:
+                self.save()
+            else:
+                self.last_updated_date = timezone.now()
+                Order.objects.filter(pk=self.pk).update(
+                    amount=self.amount,
+                    last_updated_date=self.last_updated_date,
+                    version=F("version") + 1,
+                )
+                self.version += 1  # instance version is the one just checked or saved
+                clear_user_orders_cache([self.user_id])
+            OrderItem.objects.bulk_create(new_items)
+            OrderItem.objects.bulk_update(
+                updated_items,
+                ["quantity", "product_name", "product_unit_price", "amount"],
+            )
+            OrderItem.objects.filter(
+                id__in=[item.id for item in deleted_items]
+            ).delete()
+            _apply_product_totals_changes(
+                product_totals, _get_items_product_totals(self.delivery_id, items)
+            )
+        return items
 
     @property
     def is_open(self):
@@ -200,6 +444,25 @@ class Order(models.Model):
         )
 
 
+def clear_user_orders_cache(user_ids):
+    """Invalidate cached order list of users (see get_user_orders_version), on change and again on commit"""
+
+    def bump():
+        for user_id in user_ids:
+            bump_user_orders_version(user_id)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def order_changed(instance, **kwargs):
+    clear_user_orders_cache([instance.user_id])
+
+
+post_save.connect(order_changed, sender=Order)
+post_delete.connect(order_changed, sender=Order)
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(
         Order, verbose_name=_("order"), on_delete=models.CASCADE, related_name="items"
@@ -238,9 +501,12 @@ class OrderItem(models.Model):
     def save(self, *args, **kwargs):
         self._update_saved_product_data()
         self._update_amount()
-        super().save(*args, **kwargs)
-        # Recalculate order.amount with this item
-        self.order.save()
+        if _defer_order_update(self.order_id):
+            return super().save(*args, **kwargs)
+        with transaction.atomic(), product_totals_updated([self.order_id]):
+            super().save(*args, **kwargs)
+            # Recalculate order.amount with this item
+            self.order.save()
 
     def _update_saved_product_data(self):
         """Saved product data is updated for opened orders and initialized when creating closed ones (tests or admin)"""
@@ -256,18 +522,19 @@ class OrderItem(models.Model):
         self.amount = self.quantity * unit_price
 
     def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        # Recalculate related order.amount
-        self.order.save()
-        if not self.order.items.count():
-            self.order.delete()
+        if _defer_order_update(self.order_id):
+            return super().delete(*args, **kwargs)
+        with transaction.atomic(), product_totals_updated([self.order_id]):
+            super().delete(*args, **kwargs)
+            # Recalculate related order.amount
+            self.order.save()
+            if not self.order.items.count():
+                self.order.delete()
 
     def clean(self):
-        if (
-            hasattr(
-                self.order, "delivery"
-            )  # prevent error on saving OrderItemInline if no delivery is set
-            and self.product not in self.order.delivery.products.all()
+        # hasattr prevents error on saving OrderItemInline if no delivery is set
+        if hasattr(self.order, "delivery") and (
+            self.order.delivery.get_unavailable_products([self.product])
         ):
             raise ValidationError(
                 _("product '{}' not available on this delivery").format(self.product)
@@ -275,3 +542,315 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.order}: {self.quantity} x {self.product_name}"
+
+
+class DeliveryProductTotal(models.Model):
+    """Ordered quantity and number of orders per delivery product, kept up to date on order changes
+    (see product_totals_updated)"""
+
+    delivery = models.ForeignKey(
+        Delivery,
+        verbose_name=_("delivery"),
+        on_delete=models.CASCADE,
+        related_name="product_totals",
+    )
+    product = models.ForeignKey(
+        Product,
+        verbose_name=_("product"),
+        on_delete=models.CASCADE,
+        related_name="delivery_totals",
+    )
+    total_quantity = models.PositiveIntegerField(_("total quantity"), default=0)
+    order_count = models.PositiveIntegerField(_("number of orders"), default=0)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["delivery", "product"],
+                name="one total per delivery product",
+            )
+        ]
+        verbose_name = _("delivery product total")
+
+
+class _PendingOrderUpdates(threading.local):
+    """Orders touched by item writes inside the current (thread) batched_order_updates() block"""
+
+    def __init__(self):
+        self.depth = 0
+        self.order_ids = set()
+        self.product_totals = {}  # of touched orders, before their first item write
+
+
+_pending_order_updates = _PendingOrderUpdates()
+
+
+@contextmanager
+def batched_order_updates():
+    """Defer order recalculations triggered by OrderItem.save() and OrderItem.delete() inside the block.
+
+    Touched orders are recalculated once, when the outermost block exits, in the same transaction as the item writes:
+    orders left without items are deleted (as OrderItem.delete() does) and amounts of the others are updated with a
+    single UPDATE statement.
+    Note that in-memory Order instances are not refreshed.
+    """
+
+    _pending_order_updates.depth += 1
+    try:
+        with transaction.atomic():
+            yield
+            if _pending_order_updates.depth == 1:
+                recalculate_orders(_pending_order_updates.order_ids)
+                _apply_product_totals_changes(
+                    _pending_order_updates.product_totals,
+                    _get_product_totals(_pending_order_updates.order_ids),
+                )
+    finally:
+        _pending_order_updates.depth -= 1
+        if not _pending_order_updates.depth:
+            _pending_order_updates.order_ids = set()
+            _pending_order_updates.product_totals = {}
+
+
+def _defer_order_update(order_id):
+    """Mark order as touched if inside a batched_order_updates() block, before its item is written. Return True if
+    update has been deferred"""
+
+    if _pending_order_updates.depth:
+        if order_id not in _pending_order_updates.order_ids:
+            _pending_order_updates.order_ids.add(order_id)
+            for key, totals in _get_product_totals([order_id]).items():
+                _add_totals(_pending_order_updates.product_totals, key, totals)
+        return True
+    return False
+
+
+def recalculate_orders(order_ids):
+    """Set-based recalculation of orders whose items have changed: delete the ones left without items and update
+    amount of the others. Their deliveries product totals are updated by the caller (see product_totals_updated)
+    """
+
+    if not order_ids:
+        return
+    orders = Order.objects.filter(id__in=order_ids)
+    deliveries_users = list(orders.values_list("delivery", "user"))
+    orders.filter(items__isnull=True).delete()
+    orders.update_amount()
+    clear_user_orders_cache({user_id for delivery_id, user_id in deliveries_users})
+
+
+@contextmanager
+def product_totals_updated(order_ids):
+    """Apply changes made inside the block to items of given orders (including orders deleted or moved to another
+    delivery) to DeliveryProductTotal rows, as increments of the touched delivery products only
+    """
+
+    product_totals = _get_product_totals(order_ids)
+    yield
+    _apply_product_totals_changes(product_totals, _get_product_totals(order_ids))
+
+
+def _get_product_totals(order_ids):
+    """Return {(delivery id, product id): [total quantity, order count]} of given orders items"""
+
+    totals = (
+        OrderItem.objects.filter(order__in=order_ids, product__isnull=False)
+        .order_by()
+        .values_list("order__delivery", "product")
+        .annotate(Sum("quantity"), Count("order", distinct=True))
+    )
+    return {
+        (delivery_id, product_id): [total_quantity, order_count]
+        for delivery_id, product_id, total_quantity, order_count in totals
+    }
+
+
+def _get_items_product_totals(delivery_id, items):
+    """Same as _get_product_totals(), from the given items of an order of delivery"""
+
+    product_totals = {}
+    for item in items:
+        if item.product_id:
+            totals = product_totals.setdefault((delivery_id, item.product_id), [0, 1])
+            totals[0] += item.quantity
+    return product_totals
+
+
+def _add_totals(product_totals, key, totals):
+    current = product_totals.setdefault(key, [0, 0])
+    current[0] += totals[0]
+    current[1] += totals[1]
+
+
+def _apply_product_totals_changes(totals_before, totals_after):
+    """Increment DeliveryProductTotal rows by the difference between totals, so that concurrent writes on other
+    orders of the same deliveries add up. Rows left without orders are deleted"""
+
+    increments = []
+    decremented_keys = []
+    for key in totals_before.keys() | totals_after.keys():
+        quantity_before, count_before = totals_before.get(key, (0, 0))
+        quantity_after, count_after = totals_after.get(key, (0, 0))
+        quantity, count = quantity_after - quantity_before, count_after - count_before
+        if quantity >= 0 and count >= 0:
+            if quantity or count:
+                increments.append((*key, quantity, count))
+        else:
+            DeliveryProductTotal.objects.filter(
+                delivery_id=key[0], product_id=key[1]
+            ).update(
+                total_quantity=F("total_quantity") + quantity,
+                order_count=F("order_count") + count,
+            )
+            decremented_keys.append(key)
+
+    if increments:
+        # insert row or increment it if it exists (ON CONFLICT clause is supported by PostgreSQL and SQLite)
+        table = DeliveryProductTotal._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (delivery_id, product_id, total_quantity, order_count) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(increments))} "
+                "ON CONFLICT (delivery_id, product_id) DO UPDATE SET "
+                f"total_quantity = {table}.total_quantity + EXCLUDED.total_quantity, "
+                f"order_count = {table}.order_count + EXCLUDED.order_count",
+                [value for increment in increments for value in increment],
+            )
+    if decremented_keys:
+        DeliveryProductTotal.objects.filter(
+            reduce(
+                operator.or_,
+                (
+                    Q(delivery_id=d_id, product_id=p_id)
+                    for d_id, p_id in decremented_keys
+                ),
+            ),
+            order_count__lte=0,
+        ).delete()
+
+
+class OutboxEmail(models.Model):
+    """Email stored by OutboxEmailBackend in the same transaction as the data it relates to, and sent later by
+    `send_outbox_emails` command"""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("pending")
+        HELD = "held", _("held for review")
+        SENDING = "sending", _("sending")
+        SENT = "sent", _("sent")
+        FAILED = "failed", _("failed")
+
+    subject = models.TextField(_("subject"))
+    body = models.TextField(_("body"), blank=True)
+    html_body = models.TextField(_("HTML body"), blank=True)
+    from_email = models.CharField(_("from"), max_length=255)
+    to = models.JSONField(_("to"), default=list)
+    cc = models.JSONField(_("cc"), default=list)
+    bcc = models.JSONField(_("bcc"), default=list)
+    reply_to = models.JSONField(_("reply to"), default=list)
+    headers = models.JSONField(_("headers"), default=dict)
+    status = models.CharField(
+        _("status"), max_length=16, choices=Status.choices, default=Status.PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(_("attempts"), default=0)
+    next_attempt_date = models.DateTimeField(
+        _("next attempt date"), default=timezone.now
+    )
+    error = models.TextField(_("error"), blank=True)
+    creation_date = models.DateTimeField(_("creation date"), auto_now_add=True)
+    claim_date = models.DateTimeField(_("claim date"), null=True, blank=True)
+    sent_date = models.DateTimeField(_("sent date"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("outbox email")
+        ordering = ["creation_date"]
+        indexes = [models.Index(fields=["status", "next_attempt_date"])]
+
+    def __str__(self):
+        return f"{self.subject} ({self.get_status_display()})"
+
+    @classmethod
+    def from_message(cls, message, status=Status.PENDING):
+        if message.attachments:
+            # not stored in outbox, so they would be silently lost
+            raise ValueError("Outbox emails can't have attachments")
+        html_bodies = [
+            content
+            for content, mimetype in getattr(message, "alternatives", [])
+            if mimetype == "text/html"
+        ]
+        return cls(
+            subject=message.subject,
+            body=message.body,
+            html_body=html_bodies[0] if html_bodies else "",
+            from_email=message.from_email,
+            to=list(message.to),
+            cc=list(message.cc),
+            bcc=list(message.bcc),
+            reply_to=list(message.reply_to),
+            headers=message.extra_headers,
+            status=status,
+        )
+
+    def to_message(self, connection=None):
+        message = EmailMultiAlternatives(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=self.to,
+            cc=self.cc,
+            bcc=self.bcc,
+            reply_to=self.reply_to,
+            headers=self.headers,
+            connection=connection,
+        )
+        if self.html_body:
+            message.attach_alternative(self.html_body, "text/html")
+        return message
+
+    @classmethod
+    def claim_pending(cls, limit):
+        """Mark up to `limit` pending emails due for sending as being sent and return them"""
+
+        claim_date = timezone.now()
+        with transaction.atomic():
+            emails = list(
+                cls.objects.select_for_update(skip_locked=True).filter(
+                    status=cls.Status.PENDING, next_attempt_date__lte=claim_date
+                )[:limit]
+            )
+            cls.objects.filter(id__in=[e.id for e in emails]).update(
+                status=cls.Status.SENDING, claim_date=claim_date
+            )
+        for email in emails:
+            email.status = cls.Status.SENDING
+            email.claim_date = claim_date
+        return emails
+
+    @classmethod
+    def requeue_stale(cls):
+        """Queue again emails being sent for more than OUTBOX_SENDING_TIMEOUT seconds, left by a stopped sender"""
+
+        return cls.objects.filter(
+            status=cls.Status.SENDING,
+            claim_date__lt=timezone.now()
+            - timedelta(seconds=settings.OUTBOX_SENDING_TIMEOUT),
+        ).update(status=cls.Status.PENDING, claim_date=None)
+
+    def set_sent(self):
+        self.status = self.Status.SENT
+        self.sent_date = timezone.now()
+        self.error = ""
+
+    def set_failed(self, error):
+        """Schedule a new attempt with exponential backoff, or give up after OUTBOX_MAX_ATTEMPTS"""
+
+        self.attempts += 1
+        self.error = error
+        if self.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            self.status = self.Status.FAILED
+        else:
+            self.status = self.Status.PENDING
+            self.next_attempt_date = timezone.now() + timedelta(
+                seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+            )
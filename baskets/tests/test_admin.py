@@ -1,9 +1,10 @@
 from django.contrib.auth import get_user_model
+from django.core import mail
 from django.urls import reverse
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.select import Select
 
-from baskets.models import Order, OrderItem
+from baskets.models import Order, OrderItem, OutboxEmail
 from baskets.tests.common import (
     SeleniumTestCase,
     create_closed_delivery,
@@ -27,8 +28,8 @@ class TestAdmin(SeleniumTestCase):
 
 class TestProducer(TestAdmin):
     def test_product_deactivate(self):
-        """Test that when a product is deactivated, related opened order_items are removed and a message is shown with a
-        'mailto' link to contact concerned users"""
+        """Test that when a product is deactivated, related opened order_items are removed and emails to concerned
+        users are held for review in outbox"""
 
         producer = create_producer()
         product = create_product(producer)
@@ -55,10 +56,10 @@ class TestProducer(TestAdmin):
         self.assertIn(closed_order_item, OrderItem.objects.all())
 
         message = self.driver.find_element(By.CLASS_NAME, "success")
-        self.assertIn(
-            f'<a href="mailto:?bcc={opened_order_item.order.user.email}">',
-            message.get_attribute("innerHTML"),
-        )
+        self.assertIn("1 email to affected users is held for review", message.text)
+        email = OutboxEmail.objects.get(status=OutboxEmail.Status.HELD)
+        self.assertEqual(email.to, [opened_order_item.order.user.email])
+        self.assertIn(opened_order_item.product_name, email.body)
 
 
 class TestDelivery(TestAdmin):
@@ -76,7 +77,7 @@ class TestDelivery(TestAdmin):
         send_button.click()
 
     def test_action_email_users(self):
-        """Check that action 'mailto_users_from_deliveries' shows a message with a 'mailto' link"""
+        """Check that action 'email_users_from_deliveries' sends a message to users of selected deliveries"""
 
         deliveries = [create_opened_delivery() for _ in range(3)]
         orders = [
@@ -89,15 +90,17 @@ class TestDelivery(TestAdmin):
         )
         self._select_delivery(deliveries[0])
         self._select_delivery(deliveries[1])
-        self._send_action("mailto_users_from_deliveries")
+        self._send_action("email_users_from_deliveries")
+        self.driver.find_element(By.NAME, "subject").send_keys("Subject")
+        self.driver.find_element(By.NAME, "message").send_keys("Message")
+        self.driver.find_element(By.NAME, "apply").click()
 
-        message_html = self.driver.find_element(By.CLASS_NAME, "success").get_attribute(
-            "innerHTML"
+        message = self.driver.find_element(By.CLASS_NAME, "success")
+        self.assertIn("2 users have been notified by email", message.text)
+        self.assertEqual(
+            sorted(email.to for email in mail.outbox),
+            sorted([[users[0].email], [users[1].email]]),
         )
-        self.assertIn('<a href="mailto:', message_html)
-        self.assertIn(users[0].email, message_html)
-        self.assertIn(users[1].email, message_html)
-        self.assertNotIn(users[2].email, message_html)
 
     def test_inactive_products_not_shown(self):
         delivery = create_opened_delivery()
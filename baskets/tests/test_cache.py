@@ -0,0 +1,94 @@
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from baskets.cache import bump_catalog_version, get_catalog_version, get_or_build
+
+
+class CacheTestMixin:
+    def setUp(self):
+        cache.clear()
+
+    def test_get_or_build(self):
+        self.assertEqual(get_or_build("key", lambda: "value"), "value")
+        # cached value is returned without building it again
+        self.assertEqual(get_or_build("key", lambda: "other value"), "value")
+
+    def test_bump_catalog_version(self):
+        version = get_catalog_version()
+        self.assertEqual(get_catalog_version(), version)
+
+        bump_catalog_version()
+        self.assertNotEqual(get_catalog_version(), version)
+
+        # a lost version doesn't go back to a previous one
+        version = get_catalog_version()
+        cache.clear()
+        self.assertGreater(get_catalog_version(), version)
+
+    def test_bump_catalog_version_on_commit(self):
+        """Version is bumped again on commit, so entries built before from uncommitted data are invalidated"""
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            bump_catalog_version()
+        version = get_catalog_version()
+
+        callbacks[0]()
+        self.assertNotEqual(get_catalog_version(), version)
+
+    def test_get_or_build_after_concurrent_fill(self):
+        """Value set by a concurrent builder between the first get() and the lock is not built again"""
+
+        cache.set("key", "value")
+        get = cache.get
+        with patch.object(cache, "get") as cache_get:
+            # first get() misses the value
+            cache_get.side_effect = lambda key: (
+                None if cache_get.call_count == 1 else get(key)
+            )
+            self.assertEqual(get_or_build("key", lambda: "other value"), "value")
+
+        self.assertIsNone(cache.get("key:lock"))
+
+
+class LocMemCacheTest(CacheTestMixin, TestCase):
+    # file-based cache 'add' isn't atomic, so single flight is only ensured with other backends
+    def test_get_or_build_single_flight(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            time.sleep(0.2)
+            return "value"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(get_or_build("key", build)))
+            for _ in range(5)
+        ]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(results, ["value"] * 5)
+
+
+class FileBasedCacheTest(CacheTestMixin, TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        settings_override = override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": tmp_dir.name,
+                }
+            }
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        super().setUp()
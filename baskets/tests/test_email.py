@@ -0,0 +1,224 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from baskets.email import (
+    email_order_changes,
+    email_staff,
+    email_users,
+    get_order_changes,
+    send_outbox_emails,
+)
+from baskets.models import Order, OrderItem, OutboxEmail
+from baskets.tests.common import (
+    create_closed_delivery,
+    create_opened_delivery,
+    create_order_item,
+    create_user,
+)
+
+
+@override_settings(
+    EMAIL_BACKEND="baskets.email.OutboxEmailBackend",
+    OUTBOX_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    OUTBOX_MAX_ATTEMPTS=2,
+)
+class OutboxEmailTestCase(TestCase):
+    def setUp(self):
+        self.staff_user = create_user(is_staff=True)
+
+    def test_contact_email_stored_in_outbox(self):
+        response = self.client.post(
+            reverse("contact"),
+            {
+                "from_email": "user@baskets.com",
+                "subject": "Question",
+                "message": "Hello",
+            },
+        )
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.Status.PENDING)
+        self.assertEqual(email.to, [self.staff_user.email])
+        self.assertEqual(email.reply_to, ["user@baskets.com"])
+
+    def test_send_outbox_emails(self):
+        for subject in ["first", "second"]:
+            email_staff("user@baskets.com", subject, "Hello")
+
+        with patch.object(EmailBackend, "open") as open_connection:
+            self.assertEqual(send_outbox_emails(batch_size=10), 2)
+
+        open_connection.assert_called_once()  # a single connection for the batch
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, [self.staff_user.email])
+        self.assertEqual(mail.outbox[0].reply_to, ["user@baskets.com"])
+        self.assertFalse(
+            OutboxEmail.objects.exclude(status=OutboxEmail.Status.SENT).exists()
+        )
+        # sent emails are not sent again
+        self.assertEqual(send_outbox_emails(batch_size=10), 0)
+
+    def test_send_outbox_emails_retry(self):
+        email_staff("user@baskets.com", "subject", "Hello")
+
+        with patch.object(EmailBackend, "send_messages", side_effect=OSError):
+            self.assertEqual(send_outbox_emails(batch_size=10), 0)
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.Status.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertIn("OSError", email.error)
+        self.assertGreater(email.next_attempt_date, timezone.now())
+        # not sent again before next attempt date
+        self.assertEqual(send_outbox_emails(batch_size=10), 0)
+
+        # last attempt
+        OutboxEmail.objects.update(next_attempt_date=timezone.now())
+        with patch.object(EmailBackend, "send_messages", side_effect=OSError):
+            send_outbox_emails(batch_size=10)
+
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboxEmail.Status.FAILED)
+        self.assertEqual(email.attempts, 2)
+
+    def test_send_outbox_emails_no_sender_slot(self):
+        email_staff("user@baskets.com", "subject", "Hello")
+
+        with patch("baskets.email.sender_slot") as sender_slot:
+            sender_slot.return_value.__enter__.return_value = False
+            self.assertIsNone(send_outbox_emails(batch_size=10))
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxEmail.objects.get().status, OutboxEmail.Status.PENDING)
+
+    def test_send_outbox_emails_command(self):
+        for subject in ["first", "second", "third"]:
+            email_staff("user@baskets.com", subject, "Hello")
+
+        call_command(
+            "send_outbox_emails", "--once", "--batch-size=2", stdout=StringIO()
+        )
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(
+            OutboxEmail.objects.filter(status=OutboxEmail.Status.SENT).count(), 3
+        )
+
+    @override_settings(OUTBOX_SENDING_TIMEOUT=60)
+    def test_send_outbox_emails_command_requeues_stale_emails(self):
+        for subject in ["stale", "being sent"]:
+            email_staff("user@baskets.com", subject, "Hello")
+        OutboxEmail.objects.update(status=OutboxEmail.Status.SENDING)
+        OutboxEmail.objects.filter(subject__contains="stale").update(
+            claim_date=timezone.now() - timedelta(seconds=61)
+        )
+        OutboxEmail.objects.filter(subject__contains="being sent").update(
+            claim_date=timezone.now()
+        )
+
+        call_command("send_outbox_emails", "--once", stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("stale", mail.outbox[0].subject)
+        self.assertEqual(
+            OutboxEmail.objects.get(subject__contains="being sent").status,
+            OutboxEmail.Status.SENDING,
+        )
+
+    def test_email_with_attachments_rejected(self):
+        message = EmailMessage("subject", "body", to=["user@baskets.com"])
+        message.attach("file.txt", "content", "text/plain")
+
+        with self.assertRaises(ValueError):
+            message.send()
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_send_outbox_emails_closes_connection(self):
+        email_staff("user@baskets.com", "subject", "Hello")
+
+        with patch.object(
+            OutboxEmail, "set_sent", side_effect=KeyboardInterrupt
+        ), patch.object(EmailBackend, "close") as close_connection:
+            with self.assertRaises(KeyboardInterrupt):
+                send_outbox_emails(batch_size=10)
+
+        close_connection.assert_called_once()
+
+
+class UsersEmailTestCase(TestCase):
+    def test_email_users(self):
+        users = [create_user() for _ in range(3)]
+
+        emails_count = email_users(
+            get_user_model().objects.filter(id__in=[u.id for u in users[:2]]),
+            "Subject",
+            "Message",
+        )
+
+        self.assertEqual(emails_count, 2)
+        self.assertEqual(
+            sorted(email.to for email in mail.outbox),
+            sorted([u.email] for u in users[:2]),
+        )
+        self.assertIn("Message", mail.outbox[0].body)
+
+    def test_email_order_changes(self):
+        delivery = create_opened_delivery()
+        order_items = [create_order_item(delivery) for _ in range(3)]
+
+        with self.assertNumQueries(2):  # order items, held emails
+            order_changes = get_order_changes(
+                OrderItem.objects.filter(id__in=[item.id for item in order_items[:2]]),
+                lambda item: f"'{item.product_name}' changed",
+            )
+            emails_count = email_order_changes(order_changes)
+
+        self.assertEqual(emails_count, 2)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get(to=[order_items[0].order.user.email])
+        self.assertEqual(email.status, OutboxEmail.Status.HELD)
+        self.assertIn(f"'{order_items[0].product_name}' changed", email.body)
+
+    def test_deleted_orders_emails_only_for_opened_deliveries(self):
+        admin_user = get_user_model().objects.create_superuser(
+            "admin", "admin@baskets.com", "secret"
+        )
+        self.client.force_login(admin_user)
+        opened_order = create_order_item(create_opened_delivery()).order
+        closed_order = create_order_item(create_closed_delivery()).order
+
+        response = self.client.post(
+            reverse("admin:baskets_order_changelist"),
+            {
+                "action": "delete_selected",
+                "_selected_action": [opened_order.id, closed_order.id],
+                "post": "yes",
+            },
+            follow=True,
+        )
+
+        self.assertContains(response, "1 email to affected users is held for review")
+        self.assertFalse(Order.objects.exists())
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.to, [opened_order.user.email])
+        self.assertEqual(email.status, OutboxEmail.Status.HELD)
+
+        # held email is sent once reviewed
+        self.client.post(
+            reverse("admin:baskets_outboxemail_changelist"),
+            {"action": "send_emails", "_selected_action": [email.id]},
+        )
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboxEmail.Status.PENDING)
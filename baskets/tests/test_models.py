@@ -1,16 +1,24 @@
 from datetime import date, timedelta
 from decimal import Decimal
 
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.db.models import ProtectedError
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from baskets.models import (
     Delivery,
+    DeliveryProductTotal,
     InactiveProductException,
     Order,
     OrderItem,
     Producer,
     Product,
+    batched_order_updates,
+    get_opened_deliveries,
 )
 from baskets.tests.common import (
     create_closed_delivery,
@@ -35,6 +43,36 @@ class ProducerTest(TestCase):
             product.refresh_from_db()
             self.assertFalse(product.is_active)
 
+    def test_deactivate_removes_products_from_opened_deliveries_and_orders(self):
+        producer = create_producer()
+        products = [create_product(producer) for _ in range(2)]
+        other_product = create_product()
+        opened_delivery = create_opened_delivery(products + [other_product])
+        closed_delivery = create_closed_delivery(products)
+        user = create_user()
+        opened_order = Order.objects.create(delivery=opened_delivery, user=user)
+        opened_order.items.create(product=products[0], quantity=1)
+        other_item = opened_order.items.create(product=other_product, quantity=2)
+        emptied_order = create_order_item(
+            delivery=opened_delivery, product=products[1]
+        ).order
+        closed_order_item = create_order_item(
+            delivery=closed_delivery, product=products[0]
+        )
+
+        producer.is_active = False
+        user_id_list = producer.save()
+
+        self.assertCountEqual(user_id_list, [user.id, emptied_order.user.id])
+        self.assertCountEqual(opened_delivery.products.all(), [other_product])
+        self.assertCountEqual(opened_order.items.all(), [other_item])
+        opened_order.refresh_from_db()
+        self.assertEqual(opened_order.amount, other_item.amount)
+        self.assertNotIn(emptied_order, Order.objects.all())
+        # closed deliveries and orders must not be affected
+        self.assertCountEqual(closed_delivery.products.all(), products)
+        self.assertIn(closed_order_item, OrderItem.objects.all())
+
     def test_delete_deletes_releated_products(self):
         producer = create_producer()
         products = [create_product(producer) for _ in range(3)]
@@ -135,6 +173,25 @@ class ProductTest(TestCase):
         self.assertEqual(opened_order_item.amount, new_amount)
         self.assertEqual(opened_order_item.order.amount, new_amount)
 
+    def test_unit_price_update_queries_dont_depend_on_order_items_count(self):
+        product = create_product()
+        for _ in range(5):
+            create_order_item(
+                delivery=create_opened_delivery(products=[product]), product=product
+            )
+
+        product.unit_price += 1
+        # product update + users + order items update + orders update
+        with self.assertNumQueries(4):
+            product.save()
+
+        for order_item in product.order_items.all():
+            self.assertEqual(order_item.product_unit_price, product.unit_price)
+            self.assertEqual(
+                order_item.amount, order_item.quantity * product.unit_price
+            )
+            self.assertEqual(order_item.order.amount, order_item.amount)
+
     def test_update_doesnt_update_closed_orders(self):
         product = Product.objects.create(
             producer=create_producer(), name="product1", unit_price=Decimal("0.50")
@@ -194,6 +251,7 @@ class DeliveryTest(TestCase):
         closed_delivery.products.remove(product)
 
         self.assertNotIn(opened_order_item, OrderItem.objects.all())
+        self.assertNotIn(opened_order_item.order, Order.objects.all())
         # closed_order_items must not be deleted
         self.assertIn(closed_order_item, OrderItem.objects.all())
 
@@ -206,6 +264,104 @@ class DeliveryTest(TestCase):
         with self.assertRaises(InactiveProductException):
             delivery.products.add(product)
 
+    def test_get_unavailable_products(self):
+        products = [create_product() for _ in range(3)]
+        delivery = create_opened_delivery(products=products[:2])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(delivery.get_unavailable_products(products), [products[2]])
+            self.assertEqual(delivery.get_unavailable_products(products[:2]), [])
+
+        delivery.products.add(products[2])
+        self.assertEqual(delivery.get_unavailable_products(products), [])
+
+    def test_opened_deliveries_cache(self):
+        opened_delivery = create_opened_delivery()
+        create_closed_delivery()
+        self.assertEqual(get_opened_deliveries(), [opened_delivery])
+        with self.assertNumQueries(0):
+            get_opened_deliveries()
+
+        # cache is invalidated on delivery creation, update and deletion
+        new_delivery = create_opened_delivery()
+        self.assertEqual(get_opened_deliveries(), [opened_delivery, new_delivery])
+        new_delivery.order_deadline = date.today() - timedelta(days=1)
+        new_delivery.save()
+        self.assertEqual(get_opened_deliveries(), [opened_delivery])
+        opened_delivery.delete()
+        self.assertEqual(get_opened_deliveries(), [])
+
+
+class DeliveryProductTotalTest(TestCase):
+    def setUp(self):
+        self.products = [create_product() for _ in range(2)]
+        self.delivery = create_opened_delivery(products=self.products)
+        self.order = Order.objects.create(delivery=self.delivery, user=create_user())
+        self.item = self.order.items.create(product=self.products[0], quantity=2)
+        self.order.items.create(product=self.products[1], quantity=1)
+        self.other_order = Order.objects.create(
+            delivery=self.delivery, user=create_user()
+        )
+        self.other_order.items.create(product=self.products[0], quantity=3)
+
+    def _get_totals(self):
+        return {
+            t.product: (t.total_quantity, t.order_count)
+            for t in DeliveryProductTotal.objects.filter(delivery=self.delivery)
+        }
+
+    def test_order_items_create(self):
+        self.assertEqual(
+            self._get_totals(), {self.products[0]: (5, 2), self.products[1]: (1, 1)}
+        )
+
+    def test_order_item_update(self):
+        self.item.quantity = 4
+        self.item.save()
+
+        self.assertEqual(self._get_totals()[self.products[0]], (7, 2))
+
+    def test_order_item_delete(self):
+        self.item.delete()
+
+        self.assertEqual(self._get_totals()[self.products[0]], (3, 1))
+
+    def test_order_delete(self):
+        self.other_order.delete()
+
+        self.assertEqual(
+            self._get_totals(), {self.products[0]: (2, 1), self.products[1]: (1, 1)}
+        )
+
+    def test_delivery_product_remove(self):
+        self.delivery.products.remove(self.products[0])
+
+        self.assertEqual(self._get_totals(), {self.products[1]: (1, 1)})
+
+    def test_only_touched_products_updated(self):
+        """Totals are incremented, rows of other products aren't rebuilt"""
+
+        DeliveryProductTotal.objects.filter(product=self.products[1]).update(
+            total_quantity=10
+        )
+        self.item.quantity = 4
+        self.item.save()
+
+        self.assertEqual(
+            self._get_totals(), {self.products[0]: (7, 2), self.products[1]: (10, 1)}
+        )
+
+    def test_batched_order_updates(self):
+        with batched_order_updates():
+            self.item.quantity = 4
+            self.item.save()
+            for item in self.other_order.items.all():
+                item.delete()
+
+        self.assertEqual(
+            self._get_totals(), {self.products[0]: (4, 1), self.products[1]: (1, 1)}
+        )
+
 
 class OrderTest(TestCase):
     def setUp(self):
@@ -236,6 +392,55 @@ class OrderTest(TestCase):
             sum(item.quantity * item.product.unit_price for item in order.items.all()),
         )
 
+    def test_update_items(self):
+        products = [create_product() for _ in range(3)]
+        delivery = create_opened_delivery(products=products)
+        order = Order.objects.create(delivery=delivery, user=self.user)
+        kept_item = order.items.create(product=products[0], quantity=1)
+        updated_item = order.items.create(product=products[1], quantity=1)
+
+        order.update_items({products[0]: 1, products[1]: 4, products[2]: 2})
+
+        items = {item.product: item for item in order.items.all()}
+        self.assertEqual(set(items), set(products))
+        # items are kept
+        self.assertEqual(items[products[0]].id, kept_item.id)
+        self.assertEqual(items[products[1]].id, updated_item.id)
+        self.assertEqual(items[products[1]].quantity, 4)
+        self.assertEqual(items[products[1]].amount, 4 * products[1].unit_price)
+        self.assertEqual(items[products[2]].product_name, products[2].name)
+        order.refresh_from_db()
+        self.assertEqual(order.amount, sum(item.amount for item in items.values()))
+
+        order.update_items({products[2]: 1})
+
+        self.assertEqual([item.product for item in order.items.all()], [products[2]])
+        order.refresh_from_db()
+        self.assertEqual(order.amount, products[2].unit_price)
+        self.assertEqual(
+            DeliveryProductTotal.objects.get(product=products[2]).total_quantity, 1
+        )
+
+    def test_update_items_queries_dont_depend_on_items_count(self):
+        def get_queries_count():
+            quantities = {item.product: item.quantity for item in order.items.all()}
+            quantities[product] += 1  # change one quantity
+            with CaptureQueriesContext(connection) as ctx:
+                order.update_items(quantities)
+            return len(ctx.captured_queries)
+
+        delivery = create_opened_delivery()
+        product = delivery.products.first()
+        order = Order.objects.create(delivery=delivery, user=self.user)
+        order.items.create(product=product, quantity=1)
+        queries_count = get_queries_count()
+
+        for _ in range(3):
+            other_product = create_product()
+            delivery.products.add(other_product)
+            order.items.create(product=other_product, quantity=2)
+            self.assertEqual(get_queries_count(), queries_count)
+
 
 class OrderItemTest(TestCase):
     def test_order_items_count(self):
@@ -333,3 +538,123 @@ class OrderItemTest(TestCase):
         closed_order2.items.first().delete()
         self.assertNotIn(opened_order2, Order.objects.all())
         self.assertNotIn(closed_order2, Order.objects.all())
+
+    def test_clean_product_not_available(self):
+        order_item = create_order_item(delivery=create_opened_delivery())
+        order_item.clean()
+
+        order_item.product = create_product()
+        with self.assertRaises(ValidationError):
+            order_item.clean()
+
+    def test_batched_updates_recalculate_orders_once(self):
+        products = [create_product() for _ in range(3)]
+        delivery = create_opened_delivery(products=products)
+        order = Order.objects.create(delivery=delivery, user=create_user())
+        emptied_order = create_order_item(delivery=delivery).order
+
+        with CaptureQueriesContext(connection) as ctx:
+            with batched_order_updates():
+                for product in products:
+                    order.items.create(product=product, quantity=2)
+                emptied_order.items.first().delete()
+
+        order_updates = [
+            q
+            for q in ctx.captured_queries
+            if q["sql"].startswith('UPDATE "baskets_order"')
+        ]
+        self.assertEqual(len(order_updates), 1)
+
+        order.refresh_from_db()
+        self.assertEqual(
+            order.amount, sum(2 * product.unit_price for product in products)
+        )
+        self.assertNotIn(emptied_order, Order.objects.all())
+
+    def test_admin_order_items_changes_batched(self):
+        products = [create_product() for _ in range(3)]
+        delivery = create_opened_delivery(products=products)
+        order_item = create_order_item(delivery=delivery, product=products[0])
+        order = order_item.order
+        self.client.force_login(
+            get_user_model().objects.create_superuser("admin", "admin@baskets.com")
+        )
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                reverse("admin:baskets_order_change", args=[order.id]),
+                {
+                    "user": order.user.id,
+                    "delivery": delivery.id,
+                    "message": "",
+                    "items-TOTAL_FORMS": 3,
+                    "items-INITIAL_FORMS": 1,
+                    "items-0-id": order_item.id,
+                    "items-0-order": order.id,
+                    "items-0-product": products[0].id,
+                    "items-0-quantity": 2,
+                    **{
+                        f"items-{i}-{field}": value
+                        for i in [1, 2]
+                        for field, value in [
+                            ("order", order.id),
+                            ("product", products[i].id),
+                            ("quantity", 1),
+                        ]
+                    },
+                },
+            )
+
+        self.assertEqual(response.status_code, 302)
+        order_updates = [
+            q
+            for q in ctx.captured_queries
+            if q["sql"].startswith('UPDATE "baskets_order"')
+        ]
+        self.assertEqual(len(order_updates), 2)  # order form save, then items batch
+        order.refresh_from_db()
+        self.assertEqual(
+            order.amount,
+            2 * products[0].unit_price
+            + products[1].unit_price
+            + products[2].unit_price,
+        )
+        self.assertEqual(
+            sorted(
+                DeliveryProductTotal.objects.filter(delivery=delivery).values_list(
+                    "product", "total_quantity"
+                )
+            ),
+            [(products[0].id, 2), (products[1].id, 1), (products[2].id, 1)],
+        )
+
+    def test_admin_delete_selected_items(self):
+        delivery = create_opened_delivery()
+        product = delivery.products.first()
+        emptied_order = create_order_item(delivery, product=product).order
+        order_item = create_order_item(delivery, product=product)
+        order = order_item.order
+        kept_item = order.items.create(product=create_product(), quantity=1)
+        self.client.force_login(
+            get_user_model().objects.create_superuser("admin", "admin@baskets.com")
+        )
+
+        response = self.client.post(
+            reverse("admin:baskets_orderitem_changelist"),
+            {
+                "action": "delete_selected",
+                "_selected_action": [emptied_order.items.get().id, order_item.id],
+                "post": "yes",
+            },
+        )
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Order.objects.filter(id=emptied_order.id).exists())
+        order.refresh_from_db()
+        self.assertEqual(order.amount, kept_item.amount)
+        self.assertFalse(
+            DeliveryProductTotal.objects.filter(
+                delivery=delivery, product=product
+            ).exists()
+        )
@@ -1,6 +1,12 @@
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
+from django.utils.html import escape
 
+from api.pagination import OrderCursorPagination
 from baskets.tests.common import (
     create_closed_delivery,
     create_opened_delivery,
@@ -11,6 +17,7 @@ from baskets.tests.common import (
 
 class WebPageTestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = create_user()
         # deliveries
         self.closed_deliveries = [create_closed_delivery() for _ in range(4)]
@@ -51,6 +58,44 @@ class WebPageTestCase(TestCase):
             shown_deliveries, sorted(self.opened_deliveries, key=lambda x: x.date)
         )
 
+    def test_index_user_orders(self):
+        """Check that 'index' page shows user orders of opened deliveries with a constant number of queries"""
+
+        self.client.force_login(self.user)
+        self.client.get(reverse("index"))  # fill opened deliveries cache
+        create_order_item(delivery=self.opened_deliveries[1], user=self.user)
+
+        # session, user and user orders
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("index"))
+
+        shown_orders = [item["order"] for item in response.context["deliveries_orders"]]
+        self.assertEqual(
+            shown_orders,
+            [d.orders.filter(user=self.user).first() for d in self.opened_deliveries],
+        )
+
+    def test_index_order_list_cached(self):
+        """Check that 'index' page order list is cached until user orders change"""
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("index"))
+        order_list = response.content
+
+        # session and user only
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.content, order_list)
+
+        order_item = self.opened_deliveries[0].orders.get(user=self.user).items.get()
+        order_item.quantity += 1
+        order_item.save()
+        order_item.order.refresh_from_db()
+
+        response = self.client.get(reverse("index"))
+        self.assertNotEqual(response.content, order_list)
+        self.assertContains(response, f"{order_item.order.amount} €")
+
     def test_order_history_closed_deliveries(self):
         """Check that 'order history' page shows only closed user orders (deadline passed)
         in reverse chronological order"""
@@ -67,3 +112,52 @@ class WebPageTestCase(TestCase):
             shown_orders,
             sorted(self.closed_orders, key=lambda x: x.delivery.date, reverse=True),
         )
+        self.assertFalse(response.context["next_page_url"])
+
+    @patch.object(OrderCursorPagination, "page_size", 1)
+    def test_order_history_next_page_url(self):
+        """Check that 'order history' page shows first page of closed orders, next ones can be loaded from API"""
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("order_history"))
+
+        closed_orders = sorted(
+            self.closed_orders, key=lambda x: x.delivery.date, reverse=True
+        )
+        self.assertEqual(
+            [item["order"] for item in response.context["deliveries_orders"]],
+            closed_orders[:1],
+        )
+        next_page_url = str(response.context["next_page_url"])
+        self.assertContains(response, f'data-url="{escape(next_page_url)}"')
+        response = self.client.get(next_page_url)
+        self.assertEqual(
+            [order["url"] for order in response.json()["results"]],
+            [
+                response.wsgi_request.build_absolute_uri(
+                    reverse("order-detail", args=[closed_orders[1].id])
+                )
+            ],
+        )
+
+    @patch.object(OrderCursorPagination, "page_size", 1)
+    def test_order_history_cached_per_page(self):
+        """Check that cached order list of 'order history' first page isn't served for other pages"""
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("order_history"))
+        closed_orders = sorted(
+            self.closed_orders, key=lambda x: x.delivery.date, reverse=True
+        )
+        cursor = parse_qs(urlparse(str(response.context["next_page_url"])).query)[
+            "cursor"
+        ][0]
+
+        response = self.client.get(reverse("order_history"), {"cursor": cursor})
+
+        self.assertContains(
+            response, reverse("order-detail", args=[closed_orders[1].id])
+        )
+        self.assertNotContains(
+            response, reverse("order-detail", args=[closed_orders[0].id])
+        )
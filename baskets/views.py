@@ -2,13 +2,25 @@ from datetime import date
 
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
-from django.urls import reverse_lazy
+from django.db.models import Prefetch, prefetch_related_objects
+from django.urls import reverse, reverse_lazy
+from django.utils.functional import SimpleLazyObject, cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import FormView, TemplateView
+from rest_framework.request import Request
 
+from api.pagination import OrderCursorPagination
+
+from .cache import get_catalog_version, get_user_orders_version
 from .email import email_staff
 from .forms import ContactForm
-from .models import Delivery
+from .models import get_opened_deliveries
+
+
+def get_order_list_version(user):
+    """Version of user order list, changed with user orders, deliveries and every day (orders get closed)"""
+
+    return f"{get_user_orders_version(user.id)}-{get_catalog_version()}-{date.today()}"
 
 
 class IndexPageView(LoginRequiredMixin, TemplateView):
@@ -17,35 +29,63 @@ class IndexPageView(LoginRequiredMixin, TemplateView):
     template_name = "baskets/orders.html"
 
     def get_context_data(self, **kwargs):
-        opened_deliveries = Delivery.objects.filter(
-            order_deadline__gte=date.today()
-        ).order_by("date")
-
         return {
             "title": _("Next orders"),
-            "deliveries_orders": [
-                {
-                    "delivery": d,
-                    "order": d.orders.filter(user=self.request.user).first(),
-                }
-                for d in opened_deliveries
-            ],
+            "load_dashboard": True,  # order view is filled from dashboard API
+            "order_list_version": get_order_list_version(self.request.user),
+            # only evaluated if order list isn't cached
+            "deliveries_orders": SimpleLazyObject(self.get_deliveries_orders),
         }
 
+    def get_deliveries_orders(self):
+        deliveries = get_opened_deliveries()
+        # user orders of all deliveries are fetched at once (a user has at most one order per delivery)
+        prefetch_related_objects(
+            deliveries,
+            Prefetch(
+                "orders",
+                queryset=self.request.user.orders.all(),
+                to_attr="user_orders",
+            ),
+        )
+        return [
+            {"delivery": d, "order": next(iter(d.user_orders), None)}
+            for d in deliveries
+        ]
+
 
 class OrderHistoryPageView(LoginRequiredMixin, TemplateView):
     template_name = "baskets/orders.html"
 
     def get_context_data(self, **kwargs):
-        closed_user_orders = self.request.user.orders.filter(
-            delivery__order_deadline__lt=date.today()
-        ).order_by("-delivery__date")
+        return {
+            "title": _("Order history"),
+            "order_list_version": get_order_list_version(self.request.user),
+            # only evaluated if order list isn't cached
+            "deliveries_orders": SimpleLazyObject(
+                lambda: self.first_page["deliveries_orders"]
+            ),
+            "next_page_url": SimpleLazyObject(lambda: self.first_page["next_page_url"]),
+        }
 
-        deliveries_orders = [
-            {"delivery": o.delivery, "order": o} for o in closed_user_orders
-        ]
+    @cached_property
+    def first_page(self):
+        # first page of closed orders, next ones are loaded from API by the page on scroll
+        paginator = OrderCursorPagination()
+        closed_user_orders = paginator.paginate_queryset(
+            self.request.user.orders.closed().latest_delivery_first(),
+            Request(self.request),
+        )
+        paginator.base_url = (
+            self.request.build_absolute_uri(reverse("order-list")) + "?is_open=false"
+        )
 
-        return {"title": _("Order history"), "deliveries_orders": deliveries_orders}
+        return {
+            "deliveries_orders": [
+                {"delivery": o.delivery, "order": o} for o in closed_user_orders
+            ],
+            "next_page_url": paginator.get_next_link(),
+        }
 
 
 class ContactPageView(SuccessMessageMixin, FormView):
@@ -96,6 +96,18 @@ DATABASES = {
     ),
 }
 
+# Local memory cache by default. On production, use a backend shared by all server processes and with atomic add()
+# (single-flight cache fills rely on it, see baskets.cache.get_or_build), ex:
+# CACHE_BACKEND=django.core.cache.backends.memcached.PyMemcacheCache and CACHE_LOCATION=127.0.0.1:11211
+CACHES = {
+    "default": {
+        "BACKEND": env.str(
+            "CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": env.str("CACHE_LOCATION", default=""),
+    }
+}
+
 AUTH_USER_MODEL = "accounts.CustomUser"
 
 # Password validation
@@ -154,6 +166,14 @@ STATICFILES_FINDERS = [
 
 LOGIN_URL = "account_login"
 
+# Staff exports: generated by `run_export_worker` command and stored on EXPORT_FILES_DIR
+EXPORT_FILES_DIR = env.str(
+    "EXPORT_FILES_DIR", default=os.path.join(BASE_DIR, "export_files")
+)
+EXPORT_WORKERS = env.int("EXPORT_WORKERS", default=2)  # number of worker processes
+# running jobs older than this (s) are considered left by a stopped worker, and queued again
+EXPORT_JOB_TIMEOUT = env.int("EXPORT_JOB_TIMEOUT", default=30 * 60)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -169,8 +189,17 @@ SESSION_COOKIE_SECURE = env.bool("SESSION_COOKIE_SECURE", default=True)
 CSRF_COOKIE_SECURE = env.bool("CSRF_COOKIE_SECURE", default=True)
 SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 
-EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
-# EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+# Emails are stored in outbox, then sent by `send_outbox_emails` command using OUTBOX_EMAIL_BACKEND
+EMAIL_BACKEND = "baskets.email.OutboxEmailBackend"
+OUTBOX_EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
+# OUTBOX_EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+OUTBOX_MAX_ATTEMPTS = env.int("OUTBOX_MAX_ATTEMPTS", default=5)
+# delay (s) before second attempt to send an email, doubled on each new attempt
+OUTBOX_RETRY_DELAY = env.int("OUTBOX_RETRY_DELAY", default=60)
+# max number of senders sending at once (each one over its own connection), only enforced with PostgreSQL
+OUTBOX_MAX_SENDERS = env.int("OUTBOX_MAX_SENDERS", default=2)
+# emails being sent for longer than this (s) are considered left by a stopped sender, and queued again
+OUTBOX_SENDING_TIMEOUT = env.int("OUTBOX_SENDING_TIMEOUT", default=10 * 60)
 DEFAULT_FROM_EMAIL = env.str("DEFAULT_FROM_EMAIL")
 
 # SMTP server settings
@@ -217,6 +246,8 @@ REST_FRAMEWORK = {
         "rest_framework_simplejwt.authentication.JWTAuthentication",
     ],
 }
+# Responses to API requests sent with an 'Idempotency-Key' header are replayed on retries during this time (s)
+IDEMPOTENCY_KEYS_TTL = env.int("IDEMPOTENCY_KEYS_TTL", default=24 * 60 * 60)
 # Disable browsable API on prod
 if not DEBUG:
     REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"] = (
@@ -1,24 +1,32 @@
-from io import BytesIO
+from itertools import groupby
+from operator import itemgetter
+from tempfile import SpooledTemporaryFile
 
 from django.contrib.auth import get_user_model
-from django.db.models import DecimalField, Q, Sum
-from django.db.models.functions import Coalesce
 from django.utils.translation import gettext as _
 from xlsxwriter.workbook import Workbook
 
-from baskets.models import Delivery, Producer
+from baskets.models import Delivery, Producer, Product
 
+from .models import UserMonthlyAmount
+from .rollups import refresh_monthly_totals
 
-class InMemoryWorkbook:
-    """Context manager encapsulating xlsxwriter's Workbook and BytesIO buffer"""
+
+class SpooledWorkbook:
+    """Context manager encapsulating xlsxwriter's Workbook and a spooled temporary file.
+
+    Workbook is written in 'constant_memory' mode: each row is flushed to disk as soon as next one is started, so rows
+    must be written in order. The file stays in memory until it exceeds MAX_MEMORY_SIZE, then it is rolled over to disk.
+    """
 
     WORKSHEET_NAME_MAX_LENGTH = 31
+    MAX_MEMORY_SIZE = 1024 * 1024
 
     def __init__(self):
         # Create a file-like buffer
-        self.buffer = BytesIO()
+        self.buffer = SpooledTemporaryFile(max_size=self.MAX_MEMORY_SIZE)
         # Create the Workbook object, using the buffer as its "file"
-        self.workbook = Workbook(self.buffer, {"in_memory": True})
+        self.workbook = Workbook(self.buffer, {"constant_memory": True})
 
         # Formats
         self.bold = self.workbook.add_format({"bold": True})
@@ -38,10 +46,17 @@ class InMemoryWorkbook:
 
 
 def get_order_forms_xlsx(delivery):
-    """Generate an 'in memory' Excel workbook containing order forms for given delivery, one sheet per user order"""
+    """Generate an Excel workbook file containing order forms for given delivery, one sheet per user order.
+    Items are read from their saved product data, so queries count doesn't depend on orders count
+    """
 
-    with InMemoryWorkbook() as wb:
-        for order in delivery.orders.all():
+    orders = delivery.orders.select_related("user").prefetch_related(
+        "items", "user__groups"
+    )
+    with SpooledWorkbook() as wb:
+        for order in orders:
+            # groups are prefetched, so avoid .first() which would query them again
+            group = next(iter(order.user.groups.all()), None)
             worksheet = wb.workbook.add_worksheet(
                 order.user.username[: wb.WORKSHEET_NAME_MAX_LENGTH]
             )
@@ -63,7 +78,7 @@ def get_order_forms_xlsx(delivery):
             worksheet.write(
                 row + 1,
                 col + 1,
-                order.user.groups.first().name if order.user.groups.first() else "",
+                group.name if group else "",
             )
             worksheet.write(row + 2, col, _("phone"))
             worksheet.write(row + 2, col + 1, order.user.phone)
@@ -78,8 +93,8 @@ def get_order_forms_xlsx(delivery):
 
             # order items
             for item in order.items.all():
-                worksheet.write_string(row, col, item.product.name, wb.shrink)
-                worksheet.write_number(row, col + 1, item.product.unit_price, wb.money)
+                worksheet.write_string(row, col, item.product_name, wb.shrink)
+                worksheet.write_number(row, col + 1, item.product_unit_price, wb.money)
                 worksheet.write_number(row, col + 2, item.quantity)
                 worksheet.write_number(row, col + 3, item.amount, wb.money)
                 row += 1
@@ -105,87 +120,109 @@ def get_all_delivery_dates():
     )
 
 
-def get_amount_per_user_and_month():
+def get_amount_per_user_and_month(months):
+    """Return total order amount per username for each one of given (year, month), with one query for users and
+    one for amounts (grouped per user and month on UserMonthlyAmount), pivoted in Python
+    """
+
+    amounts = {
+        (user_id, year, month): amount
+        for user_id, year, month, amount in UserMonthlyAmount.objects.values_list(
+            "user", "year", "month", "amount"
+        )
+    }
     return {
-        user: {
-            month: user.orders.aggregate(
-                total_amount=Coalesce(
-                    Sum(
-                        "amount",
-                        filter=Q(
-                            delivery__date__year=month[0],
-                            delivery__date__month=month[1],
-                        ),
-                    ),
-                    0,
-                    output_field=DecimalField(),
-                )
-            )
-            for month in get_all_delivery_dates()
-        }
-        for user in get_user_model().objects.all()
+        username: [amounts.get((user_id, *month), 0) for month in months]
+        for user_id, username in get_user_model().objects.values_list("id", "username")
     }
 
 
 def get_orders_export_xlsx():
-    """Generate an 'in memory' Excel workbook containing total order amount per user and month"""
+    """Generate an Excel workbook file containing total order amount per user and month"""
+
+    refresh_monthly_totals()
+    months = list(get_all_delivery_dates())
 
-    with InMemoryWorkbook() as wb:
+    with SpooledWorkbook() as wb:
         worksheet = wb.workbook.add_worksheet(_("orders"))
-        for row_num, (user, value) in enumerate(
-            get_amount_per_user_and_month().items(), start=1
+        for col_num, (year, month) in enumerate(months, start=1):
+            worksheet.write(0, col_num, f"{year}_{month}", wb.bold)
+        for row_num, (username, amounts) in enumerate(
+            get_amount_per_user_and_month(months).items(), start=1
         ):
-            col_num = 0
-            worksheet.write(row_num, col_num, user.username, wb.bold)
-            for (year, month), amount in value.items():
-                col_num += 1
-                worksheet.write(0, col_num, f"{year}_{month}", wb.bold)
-                worksheet.write(row_num, col_num, amount["total_amount"], wb.money)
+            worksheet.write(row_num, 0, username, wb.bold)
+            for col_num, amount in enumerate(amounts, start=1):
+                worksheet.write(row_num, col_num, amount, wb.money)
         worksheet.set_column("A:A", 20)
         return wb.buffer
 
 
-def get_quantity_per_producer_and_month(producer):
-    return {
-        product: {
-            month: product.order_items.aggregate(
-                total_quantity=Coalesce(
-                    Sum(
-                        "quantity",
-                        filter=Q(
-                            order__delivery__date__year=month[0],
-                            order__delivery__date__month=month[1],
-                        ),
-                    ),
-                    0,
-                    output_field=DecimalField(),
-                )
-            )
-            for month in get_all_delivery_dates()
+def get_quantity_per_product_and_month(months):
+    """Yield (producer id, product name, total quantity for each one of given (year, month)) for all products, in
+    producer export order. Monthly quantities of all products are read with one query, streamed from database
+    """
+
+    rows = (
+        Product.objects.order_by(
+            "-producer__is_active",
+            "producer__name",
+            "producer",
+            "name",
+            "id",
+            "monthly_quantities__year",
+            "monthly_quantities__month",
+        )
+        .values_list(
+            "producer",
+            "id",
+            "name",
+            "monthly_quantities__year",
+            "monthly_quantities__month",
+            "monthly_quantities__quantity",
+        )
+        .iterator()
+    )
+    for (producer_id, product_id, product_name), product_rows in groupby(
+        rows, key=itemgetter(0, 1, 2)
+    ):
+        quantities = {
+            (year, month): quantity for *_, year, month, quantity in product_rows
         }
-        for product in producer.products.all()
-    }
+        yield producer_id, product_name, [quantities.get(month, 0) for month in months]
 
 
 def get_producer_export_xlsx():
-    """Generate an 'in memory' Excel workbook containing summary of one sheet per producer with
+    """Generate an Excel workbook file containing summary of one sheet per producer with
     total ordered quantity per product and month"""
 
-    with InMemoryWorkbook() as wb:
-        for producer in Producer.objects.all():
+    refresh_monthly_totals()
+    months = list(get_all_delivery_dates())
+    months_header = [f"{year}_{month}" for year, month in months]
+    products_per_producer = groupby(
+        get_quantity_per_product_and_month(months), key=itemgetter(0)
+    )
+    next_producer_id, next_products = next(products_per_producer, (None, []))
+
+    with SpooledWorkbook() as wb:
+        for producer_id, producer_name in Producer.objects.order_by(
+            "-is_active", "name", "id"
+        ).values_list("id", "name"):
             worksheet = wb.workbook.add_worksheet(
-                producer.name[: wb.WORKSHEET_NAME_MAX_LENGTH]
+                producer_name[: wb.WORKSHEET_NAME_MAX_LENGTH]
             )
-            # Write data
-            for row_num, (product, value) in enumerate(
-                get_quantity_per_producer_and_month(producer).items(), start=1
-            ):
-                col_num = 0
-                worksheet.write(row_num, col_num, product.name, wb.bold)
-                for (year, month), quantity in value.items():
-                    col_num += 1
-                    worksheet.write(0, col_num, f"{year}_{month}", wb.bold)
-                    worksheet.write(row_num, col_num, quantity["total_quantity"])
+            worksheet.write_row(0, 1, months_header, wb.bold)
+            if producer_id == next_producer_id:
+                # Write data
+                for row_num, (
+                    product_producer_id,
+                    product_name,
+                    quantities,
+                ) in enumerate(next_products, start=1):
+                    worksheet.write(row_num, 0, product_name, wb.bold)
+                    worksheet.write_row(row_num, 1, quantities)
+                next_producer_id, next_products = next(
+                    products_per_producer, (None, [])
+                )
             # Force 1st column width
             worksheet.set_column("A:A", 35)
         return wb.buffer
@@ -0,0 +1,40 @@
+import traceback
+from datetime import timedelta
+
+from django.core.files import File
+from django.utils import timezone
+
+from .base import get_order_forms_xlsx, get_orders_export_xlsx, get_producer_export_xlsx
+from .models import ExportJob
+
+
+def run_export_job(job_id):
+    """Generate the export file of given job and save it on EXPORT_FILES_DIR. Called on worker processes"""
+
+    job = ExportJob.objects.select_related("delivery").get(pk=job_id)
+    try:
+        if job.kind == ExportJob.Kind.ORDER_FORMS:
+            workbook_file = get_order_forms_xlsx(job.delivery)
+        elif job.kind == ExportJob.Kind.ORDERS:
+            workbook_file = get_orders_export_xlsx()
+        else:
+            workbook_file = get_producer_export_xlsx()
+        with workbook_file:
+            job.file.save(job.filename, File(workbook_file), save=False)
+        job.status = ExportJob.Status.DONE
+    except Exception:
+        job.status = ExportJob.Status.FAILED
+        job.error = traceback.format_exc()
+    job.finished_date = timezone.now()
+    job.save()
+    return job_id
+
+
+def delete_old_export_jobs(max_age=timedelta(days=1)):
+    """Delete finished jobs older than max_age, with their files"""
+
+    for job in ExportJob.objects.filter(
+        finished_date__lt=timezone.now() - max_age
+    ).exclude(status__in=ExportJob.ACTIVE_STATUSES):
+        job.file.delete(save=False)
+        job.delete()
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from export.rollups import refresh_monthly_totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild monthly totals tables used by order and producer exports from scratch"
+    )
+
+    def handle(self, *args, **options):
+        refresh_monthly_totals(rebuild=True)
+        self.stdout.write(self.style.SUCCESS("Monthly totals rebuilt"))
@@ -0,0 +1,85 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from export.jobs import delete_old_export_jobs, run_export_job
+from export.models import ExportJob
+
+
+def _init_worker_process():
+    django.setup()  # worker processes are spawned, so Django must be set up again
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate pending staff exports, several at once on a pool of worker processes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.EXPORT_WORKERS,
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="Seconds between two checks for pending jobs",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit as soon as there are no more pending jobs",
+        )
+
+    def handle(self, *args, **options):
+        while not self.run_pool(options):
+            # a worker process died abruptly: its jobs are queued again once stale
+            self.stderr.write("Worker process pool is broken, starting a new one")
+
+    def run_pool(self, options):
+        """Run jobs on a new pool until there are no more jobs (with --once). Return False if pool gets broken"""
+
+        # jobs left running by a stopped worker are queued again (not the ones other workers are running)
+        ExportJob.requeue_stale()
+
+        # worker processes are spawned (not forked), so they don't share database connections with this process:
+        # they're created on submit, when a connection is open to claim jobs
+        with ProcessPoolExecutor(
+            max_workers=options["workers"],
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker_process,
+        ) as pool:
+            running = set()
+            while True:
+                try:
+                    for job_id in ExportJob.claim_pending(
+                        options["workers"] - len(running)
+                    ):
+                        running.add(pool.submit(run_export_job, job_id))
+                except BrokenProcessPool:
+                    return False
+                if not running:
+                    if options["once"]:
+                        return True
+                    ExportJob.requeue_stale()
+                    delete_old_export_jobs()
+                    time.sleep(options["interval"])
+                    continue
+                finished, running = wait(
+                    running, timeout=options["interval"], return_when=FIRST_COMPLETED
+                )
+                for future in finished:
+                    try:
+                        self.stdout.write(f"Export job {future.result()} finished")
+                    except BrokenProcessPool:
+                        return False
+                    except Exception as e:  # job status couldn't be saved
+                        self.stderr.write(f"Export job failed: {e!r}")
@@ -0,0 +1,118 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("baskets", "0002_deliveryproducttotal"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClosedMonth",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("year", models.PositiveSmallIntegerField(verbose_name="year")),
+                ("month", models.PositiveSmallIntegerField(verbose_name="month")),
+            ],
+            options={
+                "verbose_name": "closed month",
+            },
+        ),
+        migrations.CreateModel(
+            name="UserMonthlyAmount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("year", models.PositiveSmallIntegerField(verbose_name="year")),
+                ("month", models.PositiveSmallIntegerField(verbose_name="month")),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=2, max_digits=10, verbose_name="amount"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="monthly_amounts",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="user",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "user monthly amount",
+            },
+        ),
+        migrations.CreateModel(
+            name="ProductMonthlyQuantity",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("year", models.PositiveSmallIntegerField(verbose_name="year")),
+                ("month", models.PositiveSmallIntegerField(verbose_name="month")),
+                ("quantity", models.PositiveIntegerField(verbose_name="quantity")),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="monthly_quantities",
+                        to="baskets.product",
+                        verbose_name="product",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "product monthly quantity",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="closedmonth",
+            constraint=models.UniqueConstraint(
+                fields=("year", "month"), name="unique closed month"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="usermonthlyamount",
+            constraint=models.UniqueConstraint(
+                fields=("user", "year", "month"), name="one amount per user and month"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productmonthlyquantity",
+            constraint=models.UniqueConstraint(
+                fields=("product", "year", "month"),
+                name="one quantity per product and month",
+            ),
+        ),
+    ]
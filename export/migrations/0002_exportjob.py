@@ -0,0 +1,93 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import export.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("baskets", "0002_deliveryproducttotal"),
+        ("export", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ExportJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("order_forms", "order forms"),
+                            ("orders", "orders"),
+                            ("producers", "producers"),
+                        ],
+                        max_length=16,
+                        verbose_name="kind",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "pending"),
+                            ("running", "running"),
+                            ("done", "done"),
+                            ("failed", "failed"),
+                        ],
+                        default="pending",
+                        max_length=16,
+                        verbose_name="status",
+                    ),
+                ),
+                (
+                    "file",
+                    models.FileField(
+                        blank=True,
+                        storage=export.models.get_export_storage,
+                        upload_to="",
+                        verbose_name="file",
+                    ),
+                ),
+                ("error", models.TextField(blank=True, verbose_name="error")),
+                (
+                    "creation_date",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="creation date"
+                    ),
+                ),
+                (
+                    "finished_date",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="finished date"
+                    ),
+                ),
+                (
+                    "delivery",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="export_jobs",
+                        to="baskets.delivery",
+                        verbose_name="delivery",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "export job",
+                "ordering": ["creation_date"],
+            },
+        ),
+    ]
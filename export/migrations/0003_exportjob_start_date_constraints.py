@@ -0,0 +1,39 @@
+# Generated by Django 3.2.20 on 2026-10-17 00:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("export", "0002_exportjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exportjob",
+            name="start_date",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="start date"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="exportjob",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    ("delivery__isnull", False), ("status__in", ["pending", "running"])
+                ),
+                fields=("kind", "delivery"),
+                name="one active job per delivery export",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="exportjob",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    ("delivery__isnull", True), ("status__in", ["pending", "running"])
+                ),
+                fields=("kind",),
+                name="one active job per export",
+            ),
+        ),
+    ]
@@ -0,0 +1,232 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q, UniqueConstraint
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from baskets.models import Delivery, Order, Product
+
+
+class UserMonthlyAmount(models.Model):
+    """Total order amount per user and month (of delivery date), see refresh_monthly_totals"""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("user"),
+        on_delete=models.CASCADE,
+        related_name="monthly_amounts",
+    )
+    year = models.PositiveSmallIntegerField(_("year"))
+    month = models.PositiveSmallIntegerField(_("month"))
+    amount = models.DecimalField(_("amount"), max_digits=10, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["user", "year", "month"], name="one amount per user and month"
+            )
+        ]
+        verbose_name = _("user monthly amount")
+
+
+class ProductMonthlyQuantity(models.Model):
+    """Total ordered quantity per product and month (of delivery date), see refresh_monthly_totals"""
+
+    product = models.ForeignKey(
+        Product,
+        verbose_name=_("product"),
+        on_delete=models.CASCADE,
+        related_name="monthly_quantities",
+    )
+    year = models.PositiveSmallIntegerField(_("year"))
+    month = models.PositiveSmallIntegerField(_("month"))
+    quantity = models.PositiveIntegerField(_("quantity"))
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["product", "year", "month"],
+                name="one quantity per product and month",
+            )
+        ]
+        verbose_name = _("product monthly quantity")
+
+
+class ClosedMonth(models.Model):
+    """Month whose deliveries were all closed when its totals were computed: they won't be computed again"""
+
+    year = models.PositiveSmallIntegerField(_("year"))
+    month = models.PositiveSmallIntegerField(_("month"))
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["year", "month"], name="unique closed month")
+        ]
+        verbose_name = _("closed month")
+
+
+class ExportFileStorage(FileSystemStorage):
+    """File system storage located on EXPORT_FILES_DIR, read when used (so that it can be overridden in tests)"""
+
+    @property
+    def base_location(self):
+        return settings.EXPORT_FILES_DIR
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+
+def get_export_storage():
+    return ExportFileStorage()
+
+
+class ExportJob(models.Model):
+    """Staff export generated off the request path by `run_export_worker` command"""
+
+    class Kind(models.TextChoices):
+        ORDER_FORMS = "order_forms", _("order forms")
+        ORDERS = "orders", _("orders")
+        PRODUCERS = "producers", _("producers")
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("pending")
+        RUNNING = "running", _("running")
+        DONE = "done", _("done")
+        FAILED = "failed", _("failed")
+
+    ACTIVE_STATUSES = [Status.PENDING, Status.RUNNING]
+
+    kind = models.CharField(_("kind"), max_length=16, choices=Kind.choices)
+    delivery = models.ForeignKey(
+        Delivery,
+        verbose_name=_("delivery"),
+        null=True,  # only for order forms
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="export_jobs",
+    )
+    status = models.CharField(
+        _("status"), max_length=16, choices=Status.choices, default=Status.PENDING
+    )
+    file = models.FileField(_("file"), storage=get_export_storage, blank=True)
+    error = models.TextField(_("error"), blank=True)
+    creation_date = models.DateTimeField(_("creation date"), auto_now_add=True)
+    start_date = models.DateTimeField(_("start date"), null=True, blank=True)
+    finished_date = models.DateTimeField(_("finished date"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("export job")
+        ordering = ["creation_date"]
+        constraints = [
+            # one active job per export (delivery is null for orders and producers exports)
+            UniqueConstraint(
+                fields=["kind", "delivery"],
+                condition=Q(status__in=["pending", "running"], delivery__isnull=False),
+                name="one active job per delivery export",
+            ),
+            UniqueConstraint(
+                fields=["kind"],
+                condition=Q(status__in=["pending", "running"], delivery__isnull=True),
+                name="one active job per export",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} ({self.get_status_display()})"
+
+    @classmethod
+    def enqueue(cls, kind, delivery=None):
+        """Create a pending job, or return the pending/running one for the same export"""
+
+        active_jobs = cls.objects.filter(
+            kind=kind, delivery=delivery, status__in=cls.ACTIVE_STATUSES
+        )
+        if job := active_jobs.first():
+            return job
+        try:
+            with transaction.atomic():
+                return cls.objects.create(kind=kind, delivery=delivery)
+        except IntegrityError:  # created meanwhile by a concurrent request
+            return active_jobs.get()
+
+    @classmethod
+    def claim_pending(cls, limit):
+        """Mark up to `limit` pending jobs as running and return their ids"""
+
+        with transaction.atomic():
+            job_ids = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status=cls.Status.PENDING)
+                .values_list("id", flat=True)[:limit]
+            )
+            cls.objects.filter(id__in=job_ids).update(
+                status=cls.Status.RUNNING, start_date=timezone.now()
+            )
+        return job_ids
+
+    @classmethod
+    def requeue_stale(cls):
+        """Queue again jobs running for more than EXPORT_JOB_TIMEOUT seconds, left by a stopped or broken worker"""
+
+        return cls.objects.filter(
+            status=cls.Status.RUNNING,
+            start_date__lt=timezone.now()
+            - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT),
+        ).update(status=cls.Status.PENDING, start_date=None)
+
+    @property
+    def filename(self):
+        if self.kind == self.Kind.ORDER_FORMS:
+            return f"{self.delivery.date}_order_forms.xlsx"
+        return {
+            self.Kind.ORDERS: "order_export.xlsx",
+            self.Kind.PRODUCERS: "producer_export.xlsx",
+        }[self.kind]
+
+
+def reopen_month(d_date):
+    ClosedMonth.objects.filter(year=d_date.year, month=d_date.month).delete()
+
+
+def delivery_dates_changed(sender, instance, **kwargs):
+    """A new delivery, or a delivery whose date or order deadline changes, changes totals of its month(s)"""
+
+    d = instance
+    previous_dates = (
+        Delivery.objects.filter(pk=d.pk).values_list("date", "order_deadline").first()
+        if d.pk
+        else None
+    )
+    if previous_dates != (d.date, d.order_deadline):
+        reopen_month(d.date)
+        if previous_dates:
+            reopen_month(previous_dates[0])
+
+
+def closed_order_changed(sender, instance, **kwargs):
+    """Orders of closed deliveries can still be updated on admin: their month totals must be computed again"""
+
+    d = instance.delivery
+    if not d.is_open:
+        reopen_month(d.date)
+
+
+def order_delivery_changed(sender, instance, **kwargs):
+    """An order moved to another delivery changes totals of its previous delivery month too (previous delivery is
+    looked up by Order.save())"""
+
+    previous_delivery = getattr(instance, "previous_delivery", None)
+    if previous_delivery:
+        reopen_month(previous_delivery.date)
+
+
+pre_save.connect(delivery_dates_changed, sender=Delivery)
+pre_save.connect(order_delivery_changed, sender=Order)
+post_save.connect(closed_order_changed, sender=Order)
+post_delete.connect(closed_order_changed, sender=Order)
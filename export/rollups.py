@@ -0,0 +1,104 @@
+from datetime import date
+from functools import reduce
+from operator import or_
+
+from django.db import connection, transaction
+from django.db.models import Max, Q, Sum
+
+from baskets.models import Delivery, Order, OrderItem
+
+from .models import ClosedMonth, ProductMonthlyQuantity, UserMonthlyAmount
+
+
+def _months_q(months, prefix=""):
+    return reduce(
+        or_,
+        (
+            Q(**{f"{prefix}year": year, f"{prefix}month": month})
+            for year, month in months
+        ),
+        Q(),
+    )
+
+
+# any key, only used by refresh_monthly_totals
+MONTHLY_TOTALS_LOCK_ID = 7411
+
+
+def _lock_monthly_totals():
+    """Wait for refreshes running in other transactions (orders and producers exports may run at once on export
+    workers). PostgreSQL advisory lock is released on commit, SQLite serializes writes anyway
+    """
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [MONTHLY_TOTALS_LOCK_ID])
+
+
+def refresh_monthly_totals(rebuild=False):
+    """Update UserMonthlyAmount and ProductMonthlyQuantity tables from orders.
+
+    Months whose deliveries are all closed are computed once and then saved as ClosedMonth, so that only months with
+    opened deliveries (or reopened by a later change) are computed again. If rebuild is True, all months are computed
+    from scratch.
+    Refreshes are serialized, so that concurrent ones don't insert the same rows.
+    """
+
+    with transaction.atomic():
+        _lock_monthly_totals()
+
+        last_deadline_per_month = {
+            (year, month): last_deadline
+            for year, month, last_deadline in Delivery.objects.order_by()
+            .values_list("date__year", "date__month")
+            .annotate(Max("order_deadline"))
+        }
+        if rebuild:
+            months = set(last_deadline_per_month)
+        else:
+            months = set(last_deadline_per_month) - set(
+                ClosedMonth.objects.values_list("year", "month")
+            )
+            if not months:
+                return
+
+        if rebuild:
+            for model in [UserMonthlyAmount, ProductMonthlyQuantity, ClosedMonth]:
+                model.objects.all().delete()
+        else:
+            UserMonthlyAmount.objects.filter(_months_q(months)).delete()
+            ProductMonthlyQuantity.objects.filter(_months_q(months)).delete()
+
+        user_amounts = (
+            Order.objects.filter(_months_q(months, "delivery__date__"))
+            .order_by()
+            .values_list("user", "delivery__date__year", "delivery__date__month")
+            .annotate(Sum("amount"))
+        )
+        UserMonthlyAmount.objects.bulk_create(
+            UserMonthlyAmount(user_id=user_id, year=year, month=month, amount=amount)
+            for user_id, year, month, amount in user_amounts
+        )
+        product_quantities = (
+            OrderItem.objects.filter(
+                _months_q(months, "order__delivery__date__"), product__isnull=False
+            )
+            .order_by()
+            .values_list(
+                "product", "order__delivery__date__year", "order__delivery__date__month"
+            )
+            .annotate(Sum("quantity"))
+        )
+        ProductMonthlyQuantity.objects.bulk_create(
+            ProductMonthlyQuantity(
+                product_id=product_id, year=year, month=month, quantity=quantity
+            )
+            for product_id, year, month, quantity in product_quantities
+        )
+
+        today = date.today()
+        ClosedMonth.objects.bulk_create(
+            ClosedMonth(year=year, month=month)
+            for year, month in months
+            if last_deadline_per_month[(year, month)] < today
+        )
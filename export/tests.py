@@ -1,23 +1,66 @@
+import tempfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
-from io import BytesIO
+from io import BytesIO, StringIO
+from unittest.mock import patch
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
-from django.urls import reverse, reverse_lazy
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse, reverse_lazy
+from django.utils import timezone
 from openpyxl import load_workbook
 
 from baskets.tests.common import (
     create_closed_delivery,
+    create_opened_delivery,
     create_order_item,
     create_producer,
     create_product,
     create_user,
 )
 
+from .base import (
+    get_order_forms_xlsx,
+    get_orders_export_xlsx,
+    get_producer_export_xlsx,
+)
+from .jobs import run_export_job
+from .models import (
+    ClosedMonth,
+    ExportJob,
+    ProductMonthlyQuantity,
+    UserMonthlyAmount,
+)
+from .rollups import refresh_monthly_totals
+
 WORKSHEET_NAME_MAX_LENGTH = 31
 
 
-class TestDeliveryExport(TestCase):
+class ExportTestCase(TestCase):
+    def setUp(self):
+        files_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(files_dir.cleanup)
+        settings_override = override_settings(EXPORT_FILES_DIR=files_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get_export(self, url):
+        """Request export, generate it as `run_export_worker` command does and return its download response"""
+
+        response = self.client.get(url)
+        job_url = response.url
+        run_export_job(resolve(job_url).kwargs["job_id"])
+        return self.client.get(job_url)
+
+
+class TestDeliveryExport(ExportTestCase):
     def test_success(self):
         user = create_user()
         user.username = (
@@ -30,13 +73,14 @@ class TestDeliveryExport(TestCase):
         create_order_item(delivery=d)
 
         self.client.force_login(create_user(is_staff=True))
-        response = self.client.get(reverse("delivery_export", args=[d.id]))
+        response = self.get_export(reverse("delivery_export", args=[d.id]))
         self.assertEqual(response.status_code, 200)
 
         self.assertIn(
             f"filename={str(d.date)}", response.headers["Content-Disposition"]
         )
-        wb = load_workbook(BytesIO(response.content))
+        self.assertTrue(response.streaming)
+        wb = load_workbook(BytesIO(response.getvalue()))
         self.assertEqual(len(wb.worksheets), d.orders.count())  # one sheet per d.order
         sheets = {sheet.title: sheet for sheet in wb.worksheets}
         for order in d.orders.all():
@@ -47,14 +91,33 @@ class TestDeliveryExport(TestCase):
             order_amount = rows[-1][-1]
             self.assertEqual(f"{order_amount:.2f}", f"{order.amount:.2f}")
 
+    def test_queries_count_doesnt_depend_on_orders_count(self):
+        def get_queries_count():
+            with CaptureQueriesContext(connection) as ctx:
+                get_order_forms_xlsx(d).close()
+            return len(ctx.captured_queries)
+
+        d = create_closed_delivery()
+        group = Group.objects.create(name="group")
+        create_order_item(delivery=d).order.user.groups.add(group)
+        queries_count = get_queries_count()
+
+        for _ in range(3):
+            user = create_user()
+            user.groups.add(group)
+            order_item = create_order_item(delivery=d, user=user)
+            order_item.order.items.create(product=create_product(), quantity=2)
+        self.assertEqual(get_queries_count(), queries_count)
+
     def test_not_staff(self):
         url = reverse("delivery_export", args=[create_closed_delivery().id])
         response = self.client.get(url)
         self.assertRedirects(response, f"{reverse('admin:login')}?next={url}")
 
 
-class TestOrderExport(TestCase):
+class TestOrderExport(ExportTestCase):
     url = reverse_lazy("order_export")
+    generate_export = staticmethod(get_orders_export_xlsx)
 
     def test_success(self):
         users = [create_user() for _ in range(3)]
@@ -65,13 +128,13 @@ class TestOrderExport(TestCase):
 
         # staff member required for export
         self.client.force_login(create_user(is_staff=True))
-        response = self.client.get(self.url)
+        response = self.get_export(self.url)
         self.assertEqual(response.status_code, 200)
 
         self.assertIn(
             "filename=order_export.xlsx", response.headers["Content-Disposition"]
         )
-        wb = load_workbook(BytesIO(response.content))
+        wb = load_workbook(BytesIO(response.getvalue()))
         self.assertEqual(len(wb.worksheets), 1)
         rows = list(wb.worksheets[0].iter_rows())
         self.assertEqual(
@@ -82,20 +145,54 @@ class TestOrderExport(TestCase):
             len(cols), len(deliveries) + 1
         )  # one row per month +1 for usernames
 
+    def test_amounts(self):
+        user = create_user()
+        order_items = [
+            create_order_item(delivery=create_closed_delivery(), user=user)
+            for _ in range(2)
+        ]
+        self.client.force_login(create_user(is_staff=True))
+
+        response = self.get_export(self.url)
+
+        wb = load_workbook(BytesIO(response.getvalue()))
+        rows = {row[0]: row[1:] for row in wb.worksheets[0].iter_rows(values_only=True)}
+        self.assertAlmostEqual(
+            sum(rows[user.username]), float(sum(oi.order.amount for oi in order_items))
+        )
+
+    def test_queries_count_doesnt_depend_on_users_and_months(self):
+        def get_queries_count():
+            with CaptureQueriesContext(connection) as ctx:
+                self.generate_export().close()
+            return len(ctx.captured_queries)
+
+        d = create_closed_delivery()
+        create_order_item(delivery=d)
+        queries_count = get_queries_count()
+
+        for months in [2, 4]:
+            d = create_closed_delivery()
+            d.date -= timedelta(days=31 * months)
+            d.save()
+            [create_order_item(delivery=d) for _ in range(3)]
+            self.assertEqual(get_queries_count(), queries_count)
+
     def test_not_staff(self):
         response = self.client.get(self.url)
         self.assertRedirects(response, f"{reverse('admin:login')}?next={self.url}")
 
 
-class TestProducerExport(TestCase):
+class TestProducerExport(ExportTestCase):
     url = reverse_lazy("producer_export")
+    generate_export = staticmethod(get_producer_export_xlsx)
 
     def test_success(self):
         producers = [create_producer() for _ in range(3)]
         [create_product(producer=producer) for _ in range(4) for producer in producers]
-        producers[
-            0
-        ].name = "Long name with more than 31 chars must be cut on sheet name"
+        producers[0].name = (
+            "Long name with more than 31 chars must be cut on sheet name"
+        )
         producers[0].save()
         # not active producer and products
         producers[1].is_active = False
@@ -104,13 +201,13 @@ class TestProducerExport(TestCase):
 
         # staff member required for export
         self.client.force_login(create_user(is_staff=True))
-        response = self.client.get(self.url)
+        response = self.get_export(self.url)
         self.assertEqual(response.status_code, 200)
 
         self.assertIn(
             "filename=producer_export.xlsx", response.headers["Content-Disposition"]
         )
-        wb = load_workbook(BytesIO(response.content))
+        wb = load_workbook(BytesIO(response.getvalue()))
         self.assertEqual(
             len(wb.worksheets), len(producers)
         )  # one sheet per Producer, inactive ones are also exported
@@ -122,6 +219,280 @@ class TestProducerExport(TestCase):
                 len(rows), producer.products.count() + 1
             )  # one row per product (inactive ones included) +1 for header
 
+    def test_quantities(self):
+        products = [create_product(producer=create_producer()) for _ in range(2)]
+        deliveries = [create_closed_delivery(products) for _ in range(2)]
+        deliveries[1].date -= timedelta(days=62)
+        deliveries[1].save()
+        order_items = [
+            create_order_item(delivery=d, product=p)
+            for d in deliveries
+            for p in products
+        ]
+        self.client.force_login(create_user(is_staff=True))
+
+        response = self.get_export(self.url)
+
+        wb = load_workbook(BytesIO(response.getvalue()))
+        for product in products:
+            sheet = wb[product.producer.name]
+            rows = list(sheet.iter_rows(values_only=True))
+            self.assertEqual(rows[1][0], product.name)
+            self.assertEqual(
+                sum(rows[1][1:]),
+                sum(oi.quantity for oi in order_items if oi.product == product),
+            )
+
+    def test_queries_count_doesnt_depend_on_producers_and_products(self):
+        def get_queries_count():
+            with CaptureQueriesContext(connection) as ctx:
+                self.generate_export().close()
+            return len(ctx.captured_queries)
+
+        create_order_item(delivery=create_closed_delivery())
+        queries_count = get_queries_count()
+
+        for _ in range(2):
+            producer = create_producer()
+            products = [create_product(producer=producer) for _ in range(3)]
+            d = create_closed_delivery(products)
+            [create_order_item(delivery=d, product=p) for p in products]
+            self.assertEqual(get_queries_count(), queries_count)
+
     def test_not_staff(self):
         response = self.client.get(self.url)
         self.assertRedirects(response, f"{reverse('admin:login')}?next={self.url}")
+
+
+class TestMonthlyTotals(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        closed_delivery = create_closed_delivery([self.product])
+        closed_delivery.date -= timedelta(days=62)  # not on the same month as opened
+        closed_delivery.order_deadline = closed_delivery.date
+        closed_delivery.save()
+        self.closed_order_item = create_order_item(
+            delivery=closed_delivery, product=self.product
+        )
+        self.opened_order_item = create_order_item(
+            delivery=create_opened_delivery([self.product]), product=self.product
+        )
+
+    def _get_user_amount(self, order_item):
+        d_date = order_item.order.delivery.date
+        return UserMonthlyAmount.objects.get(
+            user=order_item.order.user, year=d_date.year, month=d_date.month
+        ).amount
+
+    def test_refresh(self):
+        refresh_monthly_totals()
+
+        for order_item in [self.closed_order_item, self.opened_order_item]:
+            self.assertEqual(self._get_user_amount(order_item), order_item.order.amount)
+            d_date = order_item.order.delivery.date
+            self.assertEqual(
+                ProductMonthlyQuantity.objects.get(
+                    product=self.product, year=d_date.year, month=d_date.month
+                ).quantity,
+                order_item.quantity,
+            )
+        # only months with all deliveries closed are saved as closed
+        d_date = self.closed_order_item.order.delivery.date
+        self.assertEqual(
+            list(ClosedMonth.objects.values_list("year", "month")),
+            [(d_date.year, d_date.month)],
+        )
+
+    def test_closed_months_computed_once(self):
+        refresh_monthly_totals()
+        UserMonthlyAmount.objects.update(amount=0)
+
+        refresh_monthly_totals()
+
+        # only opened month has been computed again
+        self.assertEqual(self._get_user_amount(self.closed_order_item), 0)
+        self.assertEqual(
+            self._get_user_amount(self.opened_order_item),
+            self.opened_order_item.order.amount,
+        )
+
+    def test_closed_order_change_reopens_month(self):
+        refresh_monthly_totals()
+        self.closed_order_item.quantity += 1
+        self.closed_order_item.save()
+
+        refresh_monthly_totals()
+
+        self.assertEqual(
+            self._get_user_amount(self.closed_order_item),
+            self.closed_order_item.order.amount,
+        )
+
+    def test_order_delivery_change_reopens_previous_month(self):
+        refresh_monthly_totals()
+        order = self.closed_order_item.order
+        previous_date = order.delivery.date
+        other_delivery = create_closed_delivery([self.product])
+        other_delivery.date = previous_date - timedelta(days=62)
+        other_delivery.order_deadline = other_delivery.date
+        other_delivery.save()
+        refresh_monthly_totals()
+
+        order.delivery = other_delivery
+        order.save()
+        refresh_monthly_totals()
+
+        self.assertFalse(
+            UserMonthlyAmount.objects.filter(
+                user=order.user, year=previous_date.year, month=previous_date.month
+            ).exists()
+        )
+        self.assertEqual(self._get_user_amount(self.closed_order_item), order.amount)
+
+    def test_rebuild_command(self):
+        refresh_monthly_totals()
+        UserMonthlyAmount.objects.update(amount=0)
+
+        call_command("rebuild_monthly_totals", stdout=StringIO())
+
+        for order_item in [self.closed_order_item, self.opened_order_item]:
+            self.assertEqual(self._get_user_amount(order_item), order_item.order.amount)
+
+
+class TestExportJob(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(create_user(is_staff=True))
+
+    def test_same_export_requests_join_active_job(self):
+        response1 = self.client.get(reverse("order_export"))
+        response2 = self.client.get(reverse("order_export"))
+        self.client.get(reverse("producer_export"))
+
+        self.assertEqual(response1.url, response2.url)
+        self.assertEqual(ExportJob.objects.count(), 2)
+
+        # once finished, a new request creates a new job
+        run_export_job(resolve(response1.url).kwargs["job_id"])
+        response3 = self.client.get(reverse("order_export"))
+        self.assertNotEqual(response3.url, response1.url)
+
+    def test_pending_job_status(self):
+        response = self.client.get(reverse("order_export"), follow=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        self.assertTemplateUsed(response, "export/job.html")
+        self.assertContains(response, 'http-equiv="refresh"')
+
+    def test_failed_job_status(self):
+        job = ExportJob.objects.create(
+            kind=ExportJob.Kind.ORDERS, status=ExportJob.Status.FAILED
+        )
+
+        response = self.client.get(reverse("export_job", args=[job.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'http-equiv="refresh"')
+
+    def test_one_active_job_per_export(self):
+        ExportJob.enqueue(ExportJob.Kind.ORDERS)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ExportJob.objects.create(kind=ExportJob.Kind.ORDERS)
+
+    def test_enqueue_joins_job_created_concurrently(self):
+        job = ExportJob.objects.create(kind=ExportJob.Kind.ORDERS)
+
+        # job is created after enqueue() looked for an active one
+        with patch.object(QuerySet, "first", return_value=None):
+            self.assertEqual(ExportJob.enqueue(ExportJob.Kind.ORDERS), job)
+
+    def test_requeue_stale(self):
+        jobs = [ExportJob.enqueue(kind) for kind in ExportJob.Kind.values[1:]]
+        ExportJob.claim_pending(2)
+        ExportJob.objects.filter(pk=jobs[0].pk).update(
+            start_date=timezone.now()
+            - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT + 1)
+        )
+
+        ExportJob.requeue_stale()
+
+        self.assertEqual(
+            [job.status for job in ExportJob.objects.order_by("id")],
+            [ExportJob.Status.PENDING, ExportJob.Status.RUNNING],
+        )
+
+    def test_claim_pending(self):
+        jobs = [ExportJob.enqueue(kind) for kind in ExportJob.Kind.values[1:]]
+
+        self.assertEqual(ExportJob.claim_pending(1), [jobs[0].id])
+        self.assertEqual(ExportJob.claim_pending(2), [jobs[1].id])
+        jobs[0].refresh_from_db()
+        self.assertEqual(jobs[0].status, ExportJob.Status.RUNNING)
+
+
+class SynchronousExecutor:
+    """Stands in for ProcessPoolExecutor, running jobs in test process (and its test database transaction)"""
+
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@patch(
+    "export.management.commands.run_export_worker.ProcessPoolExecutor",
+    SynchronousExecutor,
+)
+class TestRunExportWorkerCommand(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        SynchronousExecutor.instances.clear()
+
+    def test_run_pending_jobs(self):
+        jobs = [ExportJob.enqueue(kind) for kind in ExportJob.Kind.values[1:]]
+        stdout = StringIO()
+
+        call_command("run_export_worker", "--once", "--workers=1", stdout=stdout)
+
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.status, ExportJob.Status.DONE)
+            self.assertIn(f"Export job {job.id} finished", stdout.getvalue())
+        # worker processes don't inherit this process database connections
+        (executor,) = SynchronousExecutor.instances
+        self.assertEqual(executor.kwargs["mp_context"].get_start_method(), "spawn")
+
+    def test_broken_pool_is_replaced(self):
+        job = ExportJob.enqueue(ExportJob.Kind.ORDERS)
+        stderr = StringIO()
+
+        with patch(
+            "export.management.commands.run_export_worker.run_export_job",
+            side_effect=BrokenProcessPool,
+        ):
+            call_command(
+                "run_export_worker", "--once", stdout=StringIO(), stderr=stderr
+            )
+
+        self.assertEqual(len(SynchronousExecutor.instances), 2)
+        self.assertIn("pool is broken", stderr.getvalue())
+        # job of the dead worker process is queued again once stale
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.Status.RUNNING)
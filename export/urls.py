@@ -6,4 +6,5 @@ urlpatterns = [
     path("deliveries/<int:delivery_id>", views.delivery_export, name="delivery_export"),
     path("orders", views.order_export, name="order_export"),
     path("producers", views.producer_export, name="producer_export"),
+    path("jobs/<int:job_id>", views.export_job, name="export_job"),
 ]
@@ -1,17 +1,26 @@
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import FileResponse
+from django.shortcuts import get_object_or_404, redirect, render
 
 from baskets.models import Delivery
 
-from .base import get_order_forms_xlsx, get_orders_export_xlsx, get_producer_export_xlsx
+from .models import ExportJob
 
 
-def _prepare_excel_http_headers(filename):
-    return {
-        "Content-Type": "application/vnd.ms-excel",
-        "Content-Disposition": f"attachment; filename={filename}",
-    }
+def _excel_file_response(file, filename):
+    """Stream workbook file by chunks, file is closed once response is sent"""
+
+    response = FileResponse(file, content_type="application/vnd.ms-excel")
+    # set after init, as FileResponse derives an inline disposition from stored file name
+    response["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+def _enqueue_export(kind, delivery=None):
+    """Queue export generation (or join the one already queued) and redirect to its status page"""
+
+    job = ExportJob.enqueue(kind, delivery)
+    return redirect("export_job", job_id=job.id)
 
 
 @staff_member_required
@@ -20,27 +29,29 @@ def delivery_export(request, delivery_id):
 
     d = get_object_or_404(Delivery, id=delivery_id)
 
-    return HttpResponse(
-        get_order_forms_xlsx(d),
-        headers=_prepare_excel_http_headers(f"{d.date}_order_forms.xlsx"),
-    )
+    return _enqueue_export(ExportJob.Kind.ORDER_FORMS, d)
 
 
 @staff_member_required
 def order_export(request):
     """Download summary of user order amounts per month"""
 
-    return HttpResponse(
-        get_orders_export_xlsx(),
-        headers=_prepare_excel_http_headers("order_export.xlsx"),
-    )
+    return _enqueue_export(ExportJob.Kind.ORDERS)
 
 
 @staff_member_required
 def producer_export(request):
     """Download summary of ordered product quantities per month, one sheet per producer"""
 
-    return HttpResponse(
-        get_producer_export_xlsx(),
-        headers=_prepare_excel_http_headers("producer_export.xlsx"),
-    )
+    return _enqueue_export(ExportJob.Kind.PRODUCERS)
+
+
+@staff_member_required
+def export_job(request, job_id):
+    """Show export job status (page is refreshed until job is finished), then download its file"""
+
+    job = get_object_or_404(ExportJob.objects.select_related("delivery"), id=job_id)
+    if job.status == ExportJob.Status.DONE:
+        return _excel_file_response(job.file.open("rb"), job.filename)
+
+    return render(request, "export/job.html", {"job": job})
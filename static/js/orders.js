@@ -3,16 +3,37 @@ const headers = {
   'Content-Type': 'application/json; charset=UTF-8',
 };
 
+// delivery and order details already fetched, with their ETag: {url: {etag, data}}
+const responsesCache = new Map();
+// 'Next orders' page: opened deliveries detail and user orders, loaded at once. {deliveryId: {delivery, order}}
+let dashboard = null;
+// ETag of the order shown in order-view, sent as 'If-Match' header on its update or deletion
+let orderEtag = null;
+
 document.addEventListener('DOMContentLoaded', function() {
 
+  const dashboardInput = document.querySelector('#dashboard');
+  if (dashboardInput) {
+    dashboard = requestGetDashboard(dashboardInput.dataset.url);
+  }
+
   // Manage clicks on order list items
-  document.querySelectorAll('.order-list-item').forEach(orderListItem => {
-    orderListItem.addEventListener('click', () => {
-      highlightOrderListItem(orderListItem);
-      clearAlert();
-      updateOrderView(orderListItem);
-    })
-  })
+  document.querySelectorAll('.order-list-item').forEach(orderListItem => addOrderListItemListener(orderListItem));
+
+  // 'Order history' page: load next orders when end of list is reached (infinite scroll)
+  const nextPage = document.querySelector('#next-page');
+  if (nextPage) {
+    const observer = new IntersectionObserver(async entries => {
+      if (entries[0].isIntersecting && nextPage.dataset.url) {
+        observer.unobserve(nextPage);
+        await loadNextOrders(nextPage);
+        if (nextPage.dataset.url) {
+          observer.observe(nextPage);
+        }
+      }
+    });
+    observer.observe(nextPage);
+  }
 
   // Manage clicks on 'Save' and 'Delete' order buttons
   document.querySelector('#save').addEventListener('click', () => saveOrder());
@@ -20,6 +41,42 @@ document.addEventListener('DOMContentLoaded', function() {
 
 })
 
+function addOrderListItemListener(orderListItem) {
+  orderListItem.addEventListener('click', () => {
+    highlightOrderListItem(orderListItem);
+    clearAlert();
+    updateOrderView(orderListItem);
+  })
+}
+
+async function loadNextOrders(nextPage) {
+  // Append next page of orders to order list, then keep the url of the following one
+  const ordersPage = await requestGetOrders(nextPage.dataset.url);
+  const orderListItems = document.querySelector('#order-list tbody');
+  ordersPage.results.forEach(order => {
+    const orderListItem = document.createElement('tr');
+    orderListItem.className = 'order-list-item';
+    orderListItem.innerHTML = `
+      <td class="delivery"></td>
+      <td class="order">${order.amount} €</td>`;
+    const delivery = orderListItem.querySelector('.delivery');
+    delivery.dataset.url = new URL(order.delivery.url).pathname;
+    delivery.dataset.orderdeadline = formatDate(order.delivery.order_deadline);
+    delivery.innerText = formatDate(order.delivery.date);
+    orderListItem.querySelector('.order').dataset.url = order.url;
+    addOrderListItemListener(orderListItem);
+    orderListItems.append(orderListItem);
+  })
+  nextPage.dataset.url = ordersPage.next || '';
+
+  function formatDate(isoDate) {
+    // same format as 'SHORT_DATE_FORMAT' used on server-side rendered items
+    return new Date(isoDate + 'T00:00').toLocaleDateString(document.documentElement.lang, {
+      day: '2-digit', month: '2-digit', year: 'numeric',
+    });
+  }
+}
+
 async function updateOrderView(selectedOrderListItem) {
   // Load selected order-list-item in order-view. If item has no order, display an empty order form.
   const deliveryDate = selectedOrderListItem.querySelector('.delivery').innerText;
@@ -41,8 +98,18 @@ async function updateOrderView(selectedOrderListItem) {
   hide(orderView);
   show(spinner);
 
-  let delivery = null;
-  const order = (orderUrl !== '') ? await requestGetOrder(orderUrl) : null;
+  const deliveryId = deliveryUrl.split('/').at(-2);
+  const dashboardItem = dashboard ? (await dashboard)[deliveryId] : null;
+  let delivery = dashboardItem ? dashboardItem.delivery : null;
+  let order = null;
+  orderEtag = null;
+  if (dashboardItem) {
+    order = dashboardItem.order;
+    orderEtag = dashboardItem.order_etag;
+  } else if (orderUrl !== '') {
+    order = await requestGetOrder(orderUrl);
+    orderEtag = responsesCache.get(orderUrl)?.etag;
+  }
 
   orderViewItemsContainer.innerHTML = '';
   producerList.innerHTML = '';
@@ -52,7 +119,7 @@ async function updateOrderView(selectedOrderListItem) {
       orderViewTitle.innerText = gettext('Order for ') + deliveryDate;
       if (order.is_open) {
         // order can be updated and deleted
-        delivery = await requestGetDelivery(deliveryUrl);
+        delivery = delivery || await requestGetDelivery(deliveryUrl);
         orderViewSubtitle.innerText = gettext('Can be updated until: ') + deliveryOrderDeadline;
         orderViewMessage.innerText = delivery.message;
         delivery.message ? show(orderViewMessage) : hide(orderViewMessage);
@@ -75,7 +142,7 @@ async function updateOrderView(selectedOrderListItem) {
     orderView.classList.remove('border-success');
     orderView.classList.remove('shadow');
     orderViewTitle.innerText = gettext('New order for ') + deliveryDate;
-    delivery = await requestGetDelivery(deliveryUrl);
+    delivery = delivery || await requestGetDelivery(deliveryUrl);
     orderViewSubtitle.innerText = gettext('Last day to order: ') + deliveryOrderDeadline;
     orderViewMessage.innerText = delivery.message;
     delivery.message ? show(orderViewMessage) : hide(orderViewMessage);
@@ -233,6 +300,7 @@ async function saveOrder() {
 
     // if order amount sent by back-end matches front-end one, order has been successfully created/updated
     if (result.amount === orderAmount) {
+      await updateDashboardOrder(deliveryId, result, orderEtag);
       updateSelectedOrderListItem(orderAmount, orderUrl);
       highlightOrderListItem(null);
       restartAnimation(selectedOrderListItem.querySelector('.order'));
@@ -272,61 +340,123 @@ async function deleteOrder() {
   const response = await requestDeleteOrder(orderUrl);
 
   if (response.status == 204) {
+    const deliveryId = selectedOrderListItem.querySelector('.delivery').dataset.url.split('/').at(-2);
+    await updateDashboardOrder(deliveryId, null, null);
     updateSelectedOrderListItem(null, '');
     highlightOrderListItem(null);
     showAlert('successRemove');
     hide(orderView);
+  } else if (response.status == 412) {
+    showAlert('errorConflict');
   }
 }
 
-async function requestGetDelivery(deliveryUrl) {
-  // Send 'GET' request to get delivery details
-  const response = await fetch(deliveryUrl)
+async function updateDashboardOrder(deliveryId, order, etag) {
+  // Keep dashboard in sync with created, updated or deleted order
+  if (dashboard) {
+    const dashboardItem = (await dashboard)[deliveryId];
+    if (dashboardItem) {
+      dashboardItem.order = order;
+      dashboardItem.order_etag = etag;
+    }
+  }
+}
+
+async function requestGetDashboard(dashboardUrl) {
+  // Send 'GET' request to get opened deliveries detail and user orders, indexed by delivery id
+  const response = await fetch(dashboardUrl)
+  .catch(error => showAlert(error.message));
+  const items = await response.json();
+  return Object.fromEntries(items.map(item => [item.delivery.id, item]));
+}
+
+async function requestGetOrders(ordersUrl) {
+  // Send 'GET' request to get a page of user orders
+  const response = await fetch(ordersUrl)
   .catch(error => showAlert(error.message));
   return await response.json();
 }
 
+async function requestGetDelivery(deliveryUrl) {
+  // Send 'GET' request to get delivery details
+  return await requestGetCached(deliveryUrl);
+}
+
 async function requestGetOrder(orderUrl) {
   // Send 'GET' request to get order details
-  const response = await fetch(orderUrl)
+  return await requestGetCached(orderUrl);
+}
+
+async function requestGetCached(url) {
+  // Send 'GET' request revalidating previous response (if any): back-end answers '304 Not Modified' if unchanged
+  const cached = responsesCache.get(url);
+  const response = await fetch(url, {
+    headers: cached ? {'If-None-Match': cached.etag} : {},
+    cache: 'no-store',
+  })
   .catch(error => showAlert(error.message));
-  return response.json();
+  if (response.status === 304) {
+    return cached.data;
+  }
+  const data = await response.json();
+  if (response.ok && response.headers.has('ETag')) {
+    responsesCache.set(url, {etag: response.headers.get('ETag'), data: data});
+  }
+  return data;
 }
 
 async function requestCreateOrder(deliveryId, orderItems) {
   // Send 'POST' request to create order in back-end
   const createOrderUrl = document.querySelector('#create-order').dataset.url;
-  const response = await fetch(createOrderUrl, {
+  const response = await fetchIdempotent(createOrderUrl, {
     method: 'POST',
-    headers: headers,
     body: JSON.stringify({
       'delivery': deliveryId,
       'items': orderItems,
     })
   })
   .catch(error => showAlert(error.message));
+  orderEtag = response.headers.get('ETag');
   return response.json();
 }
 
 async function requestUpdateOrder(orderUrl, deliveryId, orderItems) {
   // Send 'PUT' request to update order in back-end
-  const response = await fetch(orderUrl, {
+  const response = await fetchIdempotent(orderUrl, {
     method: 'PUT',
-    headers: headers,
+    headers: {'If-Match': orderEtag},
     body: JSON.stringify({
       'delivery': deliveryId,
       'items': orderItems,
     })
   })
   .catch(error => showAlert(error.message));
+  if (response.ok) {
+    orderEtag = response.headers.get('ETag');
+  }
   return await response.json();
 }
 
+async function fetchIdempotent(url, options, retries = 2) {
+  // Send request with an 'Idempotency-Key' header, retrying it with same key on network errors:
+  // back-end replays the response of the request if it has already been handled
+  const key = crypto.randomUUID();
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await fetch(url, {...options, headers: {...headers, ...options.headers, 'Idempotency-Key': key}});
+    } catch (error) {
+      if (attempt >= retries) {
+        throw error;
+      }
+    }
+  }
+}
+
 async function requestDeleteOrder(orderUrl) {
   // Send 'DELETE' order request to back-end
   const response = await fetch(orderUrl, {
     method: 'DELETE',
-    headers: headers,
+    headers: {...headers, 'If-Match': orderEtag},
   })
   .catch(error => showAlert(error.message));
   return response;
@@ -365,6 +495,10 @@ function showAlert(alertType) {
       alert.classList.add('text-danger');
       alert.innerText = gettext('An error occurred when trying to save order. Please reload page and try again');
       break;
+    case 'errorConflict':
+      alert.classList.add('text-danger');
+      alert.innerText = gettext('Order has been modified meanwhile. Please reload page and try again');
+      break;
     case 'errorItems':
       alert.classList.add('text-danger');
       alert.innerText = gettext('At least one item must have quantity greater than 0');